@@ -1,48 +1,857 @@
 import unittest
 import os
 import sys
+import json
+import pickle
 import inspect
+import time
+import atexit
+import csv
+import heapq
+import itertools
+import collections
+import tracemalloc
+import gc
+import array
+import types
+import reprlib
+import zlib
+import random
+import hashlib
+import sysconfig
+import dis
+import functools
+# asyncio, multiprocessing and concurrent.futures are imported where they
+# are used, so that a suite which needs none of them doesn't import them
+
+import spicy_report
+import spicy_strategies
+from spicy_report import JsonlReporter, JUnitXmlReporter, TimingsReporter
+from spicy_strategies import (Strategy, integers, booleans, sampled_from,
+                              lists, text, tuples, builds)
+
+# the files of spicy itself, which spicy_profile counts apart from the
+# code under test and spicy_watch restarts its worker for
+FRAMEWORK = ("spicy_bdd.py", "spicy_bench.py", "spicy_gherkin.py",
+             "spicy_profile.py", "spicy_report.py", "spicy_snapshot.py",
+             "spicy_strategies.py", "spicy_watch.py")
+
+
+class StderrTraceSink():
+    # human readable trace, the format SPICY_DEBUG always printed
+    def __init__(self, stream=None):
+        self._stream = stream
+
+    def write(self, event):
+        stream = self._stream or sys.stderr
+        if event["event"] == "debug":
+            print(event["where"], event["message"], file=stream)
+            return
+        fields = ["%s=%s" % (k, v) for (k, v) in event.items()
+                  if k not in ("event", "where", "time")]
+        print(event["where"], event["event"], *fields, file=stream)
+
+    def flush(self):
+        (self._stream or sys.stderr).flush()
+
+    def close(self):
+        pass
+
+
+class JsonlTraceSink():
+    # one json object per line, for tracing large suites offline
+    def __init__(self, path):
+        self._file = open(path, "a", buffering=1 << 16)
+
+    def write(self, event):
+        self._file.write(json.dumps(event, default=str) + "\n")
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Tracer():
+    # whether tracing is on is decided once by configure(). callers test
+    # `tracer.enabled` before building any message, and messages are
+    # %-formatted by the tracer only when an event is really written.
+    def __init__(self):
+        self.enabled = False
+        self.sink = None
+
+    def configure(self, sink=None):
+        if self.sink is not None and self.sink is not sink:
+            self.sink.close()
+        self.sink = sink
+        self.enabled = sink is not None
+
+    def configure_from_env(self):
+        path = os.environ.get("SPICY_TRACE")
+        if path:
+            self.configure(JsonlTraceSink(path))
+        elif os.environ.get("SPICY_DEBUG"):
+            self.configure(StderrTraceSink())
+        else:
+            self.configure(None)
 
-def debug(*args):
-    if os.environ.get("SPICY_DEBUG"):
-        i = inspect.stack()[1]
-        info = "%s:%s[%s]" % (i.filename,
-                              i.lineno,
-                              i.function)
-        del i
-        print(info, *args, file=sys.stderr)
+    def flush(self):
+        if self.sink is not None:
+            self.sink.flush()
+
+    def _where(self, depth):
+        # sys._getframe is far cheaper than inspect.stack()
+        f = sys._getframe(depth + 1)
+        return "%s:%s[%s]" % (f.f_code.co_filename, f.f_lineno,
+                              f.f_code.co_name)
+
+    def debug(self, fmt, *args, depth=1):
+        if not self.enabled:
+            return
+        message = fmt % args if args else fmt
+        self.sink.write({"event": "debug",
+                         "where": self._where(depth),
+                         "time": time.time(),
+                         "message": message})
+
+    def event(self, name, depth=1, **fields):
+        if not self.enabled:
+            return
+        event = {"event": name,
+                 "where": self._where(depth),
+                 "time": time.time()}
+        event.update(fields)
+        self.sink.write(event)
+
+
+tracer = Tracer()
+tracer.configure_from_env()
+atexit.register(tracer.configure, None)
+
+def debug(fmt, *args):
+    if tracer.enabled:
+        tracer.debug(fmt, *args, depth=2)
+
+
+reporters = spicy_report.Reporters()
+reporters.configure_from_env()
+atexit.register(reporters.configure)
 
 # helper function
+class _BoundedRepr(reprlib.Repr):
+    # renders values for spec text within size and depth limits, so that
+    # a huge argument costs no more than a small one. while a spec is
+    # rendered, the text of each object is kept by id.
+    def __init__(self):
+        super().__init__()
+        self.maxlevel = 4
+        self.maxlist = self.maxtuple = self.maxdeque = self.maxarray = 20
+        self.maxset = self.maxfrozenset = 20
+        self.maxdict = 10
+        self.maxstring = 200
+        self.maxlong = 60
+        self.maxother = 200
+        self.cache = None
+
+    def repr1(self, x, level):
+        cache = self.cache
+        if cache is None:
+            return super().repr1(x, level)
+        key = (id(x), level)
+        hit = cache.get(key)
+        if hit is not None and hit[0] is x:
+            return hit[1]
+        text = super().repr1(x, level)
+        cache[key] = (x, text)
+        return text
+
+    def repr_instance(self, x, level):
+        return self.summary(x) or super().repr_instance(x, level)
+
+    def summary(self, x):
+        # big objects of other types are only named, with their size
+        if _is_big(x):
+            return "<%s of %d items>" % (type(x).__name__, len(x))
+        return None
+
+_repr = _BoundedRepr()
+
+# values with more items than this are summarised in specs and compared
+# by the first difference in failures
+_BIG = 1000
+
+def _is_big(x):
+    try:
+        return len(x) > _BIG
+    except Exception:
+        return False
+
+_CONTAINERS = (list, tuple, dict, set, frozenset, collections.deque)
+
 def _to_str(x):
     if isinstance(x, str):
+        if len(x) > _repr.maxstring:
+            x = "%s...(%d more)" % (x[:_repr.maxstring], len(x) - _repr.maxstring)
         return "'%s'" % x
-    return str(x)
+    if isinstance(x, _CONTAINERS):
+        return _repr.repr(x)
+    text = _repr.summary(x) or str(x)
+    if len(text) > _repr.maxother:
+        text = reprlib.Repr.repr_str(_repr, text, 0)[1:-1]
+    return text
+
+def _buffer(x):
+    # a memoryview of x when it exposes the buffer protocol, else None
+    if isinstance(x, (str, list, tuple, dict)):
+        return None
+    try:
+        return memoryview(x)
+    except TypeError:
+        return None
+
+def _equal(first, second):
+    # ==, but buffers of one type are compared as memoryviews, without
+    # copying or unpacking every item the way array.array.__eq__ does
+    if type(first) is type(second):
+        a = _buffer(first)
+        if a is not None:
+            b = _buffer(second)
+            if b is not None and a.format == b.format:
+                return a == b
+    return first == second
+
+def _first_difference(first, second):
+    # index of the first differing item of two sequences. buffers are
+    # bisected with memoryview slices, which compare without copies.
+    n = min(len(first), len(second))
+    start = 0
+    a = _buffer(first)
+    b = a is not None and _buffer(second)
+    if b and a.format == b.format and a.ndim == b.ndim == 1:
+        end = n
+        while end - start > 64:
+            middle = (start + end) // 2
+            if a[start:middle] == b[start:middle]:
+                start = middle
+            else:
+                end = middle
+    return next((i for i in range(start, n) if first[i] != second[i]), n)
+
+def _fmt_difference(first, second, context=3):
+    # a short message for big unequal values: where they first differ,
+    # rather than their whole reprs
+    if isinstance(first, dict) and isinstance(second, dict):
+        lines = ["dicts differ (%d and %d keys)" % (len(first), len(second))]
+        missing = list(itertools.islice(
+            (k for k in first if k not in second), context))
+        extra = list(itertools.islice(
+            (k for k in second if k not in first), context))
+        changed = list(itertools.islice(
+            (k for k in first if k in second and first[k] != second[k]),
+            context))
+        if missing:
+            lines.append("  only in first: %s" % _to_str(missing))
+        if extra:
+            lines.append("  only in second: %s" % _to_str(extra))
+        for k in changed:
+            lines.append("  [%s]: %s != %s" % (_to_str(k), _to_str(first[k]),
+                                               _to_str(second[k])))
+        return "\n".join(lines)
+    try:
+        index = _first_difference(first, second)
+        start = max(0, index - context)
+        end = index + context + 1
+        return ("%s and %s differ at index %d (lengths %d and %d)\n"
+                "  first[%d:%d]: %s\n  second[%d:%d]: %s"
+                % (type(first).__name__, type(second).__name__, index,
+                   len(first), len(second),
+                   start, end, _to_str(first[start:end]),
+                   start, end, _to_str(second[start:end])))
+    except Exception:
+        return "%s != %s" % (_to_str(first), _to_str(second))
+
+# marks a missing value where None is a valid one
+_NOTHING = object()
+_NO_KWARGS = types.MappingProxyType({})
+
+# spec is recorded as a list of tokens. a token is a plain string or a
+# (render, args) pair, and it is turned into text only when a failure
+# message or a debug line actually needs it.
+def _render_spec(tokens):
+    if _repr.cache is not None:
+        return "".join([t if t.__class__ is str else t[0](*t[1])
+                        for t in tokens])
+    _repr.cache = {}
+    try:
+        return "".join([t if t.__class__ is str else t[0](*t[1])
+                        for t in tokens])
+    finally:
+        _repr.cache = None
+
+def _fmt_text(fmt, *args):
+    return fmt % args
+
+def _fmt_value(fmt, value):
+    return fmt % _to_str(value)
+
+def _fmt_call(name, args, kwargs):
+    specs = [_to_str(x) for x in args]
+    specs.extend(["%s=%s" % (k, _to_str(v)) for (k, v) in kwargs.items()])
+    return "%s(%s)" % (name, ", ".join(specs))
+
+def _to_seconds(ms=None, us=None, s=None):
+    values = [x for x in (s, ms and ms / 1e3, us and us / 1e6)
+              if x is not None]
+    if len(values) != 1:
+        raise TypeError("give exactly one of s, ms or us")
+    return values[0]
+
+def _to_bytes(b=None, kb=None, mb=None):
+    values = [x for x in (b, kb and kb * 1024, mb and mb * 1024 * 1024)
+              if x is not None]
+    if len(values) != 1:
+        raise TypeError("give exactly one of b, kb or mb")
+    return values[0]
+
+def _fmt_seconds(x):
+    if x >= 1:
+        return "%.3g s" % x
+    if x >= 1e-3:
+        return "%.3g ms" % (x * 1e3)
+    return "%.3g us" % (x * 1e6)
+
+def _fmt_bytes(x):
+    if x >= 1024 * 1024:
+        return "%.3g MB" % (x / 1024 / 1024)
+    if x >= 1024:
+        return "%.3g KB" % (x / 1024)
+    return "%d B" % x
+
+def _percentile(values, p):
+    # values must be sorted. linear interpolation between closest ranks
+    if not values:
+        raise ValueError("no samples")
+    k = (len(values) - 1) * p / 100
+    i = int(k)
+    if i + 1 >= len(values):
+        return values[-1]
+    return values[i] + (values[i + 1] - values[i]) * (k - i)
+
+def _growing(samples):
+    # grew over the runs, in at least three of four steps between them
+    steps = len(samples) - 1
+    grew = sum([b > a for (a, b) in zip(samples, samples[1:])])
+    return samples[-1] > samples[0] and grew * 4 >= steps * 3
+
+def _count_types():
+    # live objects by type. a collection untracks one level of nested
+    # tuples, like the traces of a snapshot, which aren't live objects of
+    # the measured code.
+    for i in range(3):
+        gc.collect()
+    return collections.Counter(map(type, gc.get_objects()))
+
+# the lines of _count_types, whose allocations aren't the measured code's
+_counting_lines = frozenset([line for (offset, line)
+                             in dis.findlinestarts(_count_types.__code__)
+                             if line is not None])
+
+def _allocation_site(traceback):
+    # the innermost frame out of this module which the measured code
+    # called, or where this module called into C (a When.Plan step).
+    # None for what _count_types allocated.
+    files = [x.filename for x in traceback]
+    if tracemalloc.__file__ in files:
+        return None
+    for frame in traceback:
+        if frame.filename == __file__ and frame.lineno in _counting_lines:
+            return None
+    outer = files.index(__file__) if __file__ in files else 0
+    inner = [x for x in traceback[outer:] if x.filename != __file__]
+    frame = inner[-1] if inner else traceback[-1]
+    return (frame.filename, frame.lineno)
+
+# fewer runs than this can't tell a leak from a cache filling up
+_MIN_LEAK_RUNS = 5
+
+def _check_growth(run, runs=10, warmup=2, limit=0, top=5):
+    # calls run() again and again, collecting garbage in between, and
+    # describes how retained memory or live objects kept growing over the
+    # runs, or returns None. limit is the growth in bytes per run let go.
+    if profiler is not None:
+        profiler.pause()
+    try:
+        return _measure_growth(run, runs, warmup, limit, top)
+    finally:
+        if profiler is not None:
+            profiler.resume()
+
+def _measure_growth(run, runs, warmup, limit, top):
+    for i in range(warmup):
+        run()
+    # samples go in arrays, which keep no objects of their own alive
+    sizes = array.array("q", bytes(8 * runs))
+    counts = array.array("q", bytes(8 * runs))
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        # deep enough to find the caller of a chain run by When.Plan
+        tracemalloc.start(8)
+    # the trace sink buffers the events of the runs, which would look
+    # retained by them
+    tracing_events = tracer.enabled
+    tracer.enabled = False
+    try:
+        first = tracemalloc.take_snapshot()
+        types = _count_types()
+        # the counter itself, which is alive at the end
+        types[collections.Counter] += 1
+        for i in range(runs):
+            run()
+            gc.collect()
+            sizes[i] = tracemalloc.get_traced_memory()[0]
+            counts[i] = len(gc.get_objects())
+        after = _count_types()
+        last = tracemalloc.take_snapshot()
+    finally:
+        tracer.enabled = tracing_events
+        if not tracing:
+            tracemalloc.stop()
+
+    growth = sizes[-1] - sizes[0]
+    leaks_memory = _growing(sizes) and growth > limit * (runs - 1)
+    leaks_objects = _growing(counts) and counts[-1] - counts[0] >= runs - 1
+    if not (leaks_memory or leaks_objects):
+        return None
+    lines = ["retained memory grew by %s, live objects by %d, in %d runs"
+             % (_fmt_bytes(max(growth, 0)), counts[-1] - counts[0],
+                runs - 1)]
+    sites = collections.Counter()
+    blocks = collections.Counter()
+    for stat in last.compare_to(first, "traceback"):
+        site = _allocation_site(stat.traceback)
+        if site is not None and stat.size_diff > 0:
+            sites[site] += stat.size_diff
+            blocks[site] += stat.count_diff
+    for (site, size) in sites.most_common(top):
+        lines.append("%s:%d: +%s in %d blocks" % (
+            site + (_fmt_bytes(size), blocks[site])))
+    for (t, n) in (after - types).most_common(top):
+        lines.append("+%d %s" % (n, t.__qualname__))
+    return "\n  ".join(lines)
+
+def _fmt_drawn(drawn):
+    return ", ".join(["%s=%s" % (k, _to_str(v)) for (k, v) in drawn])
+
+def _fmt_given_item(name, index):
+    return "%s[%s]" % (_render_spec((name,)), _to_str(index))
+
+def _fmt_given_attr(name, attr):
+    return "%s.%s" % (_render_spec((name,)), attr)
+
+def _fmt_item(name, index):
+    if name.__class__ is not str:
+        name = name[0](*name[1])
+    return "{}[{}]".format(name, index)
+
+
+class _SpecText():
+    # a spec message which renders itself on demand. it is passed to the
+    # assert* methods as msg, so it is only formatted when they fail.
+    def __init__(self, tokens, start=0):
+        self._tokens = tokens
+        self._start = start
+
+    def __str__(self):
+        return _render_spec(self._tokens[self._start:]).strip()
 
 
 class ScenarioFailure(AssertionError):
     def __init__(self, err, fixture=None):
         super().__init__(err)
         self.fixture = fixture
+        # fixtures are reused between example rows, so keep the spec
+        # tokens of this failure. they are still rendered on demand.
+        if fixture:
+            self._spec = (fixture.when._spec, fixture.then._spec)
+            choices = fixture._choices
+            self._drawn = list(choices.drawn) if choices else None
 
     def __str__(self):
         f = self.fixture
         if not f:
             return super().__str__()
 
-        spec = f.then._get_spec()
-        return "INVALID RESULT:\n  %s\n  (%s)" % (spec, super().__str__())
+        spec = f.then._get_spec(self._spec)
+        text = "INVALID RESULT:\n  %s\n  (%s)" % (spec, super().__str__())
+        if self._drawn:
+            text += "\n  falsifying example: %s" % _fmt_drawn(self._drawn)
+        return text
+
+
+class ScenarioError(Exception):
+    # an error raised by a scenario which ran in another process. only
+    # the rendered message and traceback survive the trip back.
+    def __init__(self, err, trace=None):
+        super().__init__(err)
+        self.trace = trace
+
+    def __str__(self):
+        if self.trace:
+            return self.trace
+        return super().__str__()
+
+
+def _format_error(result, test, err):
+    # a replayed error keeps the traceback it was rendered with in the
+    # process which ran it, rather than one of the replay
+    if isinstance(err[1], ScenarioError) and err[1].trace:
+        return err[1].trace
+    return result._exc_info_to_string(err, test)
+
+
+class ScenarioOutcome():
+    # picklable record of how a scenario finished. worker processes
+    # return it and the parent replays it into its own result.
+    def __init__(self, kind="success", message=None, trace=None):
+        self.kind = kind
+        self.message = message
+        self.trace = trace
+        self.timing = None
+        self.spec = None
+        self.dependencies = None
+        self.profile = None
+
+    def replay(self, test, result):
+        test.timing = self.timing
+        test.spec = self.spec
+        test.dependencies = self.dependencies
+        test.profile = self.profile
+        result.startTest(test)
+        if self.kind == "success":
+            result.addSuccess(test)
+        elif self.kind == "failure":
+            err = ScenarioFailure(self.message)
+            result.addFailure(test, (ScenarioFailure, err, None))
+        elif self.kind == "skip":
+            result.addSkip(test, self.message)
+        else:
+            err = ScenarioError(self.message, self.trace)
+            result.addError(test, (ScenarioError, err, None))
+        result.stopTest(test)
+
+
+class _OutcomeRecorder(unittest.TestResult):
+    def __init__(self):
+        super().__init__()
+        self.outcome = ScenarioOutcome()
+
+    def addSuccess(self, test):
+        self.outcome = ScenarioOutcome("success")
+
+    def addFailure(self, test, err):
+        self.outcome = ScenarioOutcome("failure", str(err[1]),
+                                       self._exc_info_to_string(err, test))
+
+    def addError(self, test, err):
+        self.outcome = ScenarioOutcome("error", str(err[1]),
+                                       _format_error(self, test, err))
+
+    def addSkip(self, test, reason):
+        self.outcome = ScenarioOutcome("skip", reason)
+
+    def stopTest(self, test):
+        super().stopTest(test)
+        self.outcome.timing = test.timing
+        self.outcome.spec = test.spec
+        self.outcome.dependencies = test.dependencies
+        self.outcome.profile = test.profile
+
+
+_worker_testcases = {}
+
+def _run_scenario_in_worker(cls, method_name, example=None):
+    # runs in a pool process. setUpClass was already called by the parent
+    # and, with the fork start method, its class state is inherited here.
+    # one test case per class and worker, so class scoped givens are
+    # built once per worker
+    testcase = _worker_testcases.get(cls)
+    if testcase is None:
+        testcase = _worker_testcases[cls] = cls()
+    test = testcase._make_scenario(method_name, example)
+    recorder = _OutcomeRecorder()
+    test.run(recorder)
+    return recorder.outcome
+
+
+def _try_example(testcase, method, scenario, f, choices, set_up=False):
+    # runs the body once over the examples of choices. returns the name
+    # of the exception it raised, or None. with set_up, the example runs
+    # between setUp and tearDown of its own, as a pool worker runs it
+    # outside of the scenario which set the test case up.
+    testcase._prepare_fixture(f, scenario)
+    f._choices = choices
+    if set_up:
+        testcase.setUp()
+    try:
+        method(f.given, f.when, f.then)
+    except (spicy_strategies.Overrun, unittest.SkipTest):
+        return None
+    except Exception as e:
+        return "%s.%s" % (type(e).__module__, type(e).__qualname__)
+    finally:
+        try:
+            if set_up:
+                testcase.tearDown()
+        finally:
+            f._close()
+            if set_up:
+                testcase.doCleanups()
+    return None
+
+def _run_examples(testcase, method, scenario, seeds, deadline,
+                  set_up=False):
+    # (choices, error) of the first seed whose example fails, or None.
+    # deadline is a time.monotonic(), the same in every process
+    f = TestCaseFixture(testcase)
+    for seed in seeds:
+        if time.monotonic() > deadline:
+            break
+        choices = spicy_strategies.Choices(rng=random.Random(seed))
+        error = _try_example(testcase, method, scenario, f, choices, set_up)
+        if error is not None:
+            return (choices.values, error)
+    return None
+
+def _replay_examples(testcase, method, scenario, candidates, error,
+                     set_up=False):
+    # the choices consumed by the first candidate which fails with error
+    f = TestCaseFixture(testcase)
+    for prefix in candidates:
+        choices = spicy_strategies.Choices(prefix)
+        if _try_example(testcase, method, scenario, f, choices,
+                        set_up) == error:
+            return choices.values
+    return None
+
+def _property_worker(cls, method_name, example, job, *args):
+    # runs in a pool process: one batch of generation or shrinking
+    testcase = _worker_testcases.get(cls)
+    if testcase is None:
+        testcase = _worker_testcases[cls] = cls()
+    scenario = testcase._make_scenario(method_name, example)
+    method = getattr(testcase, method_name)
+    return job(testcase, method, scenario, *args, set_up=True)
+
+
+class ScenarioTiming():
+    # seconds spent in setUp, the given/when/then body and tearDown of
+    # one scenario, measured with time.perf_counter. a phase which did
+    # not run stays None.
+    __slots__ = ("setup", "body", "teardown")
+
+    def __init__(self, setup=None, body=None, teardown=None):
+        self.setup = setup
+        self.body = body
+        self.teardown = teardown
+
+    @property
+    def total(self):
+        return sum([x for x in (self.setup, self.body, self.teardown)
+                    if x is not None])
+
+    def as_dict(self):
+        return {"setup": self.setup,
+                "body": self.body,
+                "teardown": self.teardown,
+                "total": self.total}
+
+    def __getstate__(self):
+        return (self.setup, self.body, self.teardown)
+
+    def __setstate__(self, state):
+        (self.setup, self.body, self.teardown) = state
 
 
 class Scenario(unittest.FunctionTestCase):
-    def __init__(self, testFunc, setUp=None, tearDown=None, description=None):
+    def __init__(self, testFunc, setUp=None, tearDown=None, description=None,
+                 name=None, testcase=None, example=None, fixture=None):
         super().__init__(testFunc, setUp=None, tearDown=None, description=None)
         self.description = description
+        self.name = name
+        self.testcase = testcase
+        self.timing = None
+        # the rendered spec, only kept while reporters are configured
+        self.spec = None
+        # {source file: [functions]} it ran, in impact selection mode
+        self.dependencies = None
+        # what SuiteProfile.stop returned, in profiling mode
+        self.profile = None
+        # (index, row) of a data-driven example, and the fixture shared
+        # by the batch of rows it belongs to
+        self.example = example
+        self.fixture = fixture
+
+    def runTest(self):
+        # the test function gets the scenario, to record its timing on it.
+        # an async scenario returns a coroutine, run on a loop of its own.
+        recorder = impact.start() if impact is not None else None
+        profile = profiler.start() if profiler is not None else None
+        try:
+            coroutine = self._testFunc(self)
+            if coroutine is not None:
+                import asyncio
+                asyncio.run(coroutine)
+        finally:
+            if profile is not None:
+                self.profile = profiler.stop(profile)
+            if recorder is not None:
+                self.dependencies = impact.stop(recorder)
+
+    async def arun(self, result):
+        # like run(), but awaits an async scenario on the running loop
+        result.startTest(self)
+        recorder = impact.start() if impact is not None else None
+        profile = profiler.start() if profiler is not None else None
+        try:
+            coroutine = self._testFunc(self)
+            if coroutine is not None:
+                await coroutine
+            if profile is not None:
+                self.profile = profiler.stop(profile)
+                profile = None
+            if recorder is not None:
+                self.dependencies = impact.stop(recorder)
+                recorder = None
+        except unittest.SkipTest as e:
+            result.addSkip(self, str(e))
+        except self.failureException:
+            result.addFailure(self, sys.exc_info())
+        except Exception:
+            result.addError(self, sys.exc_info())
+        else:
+            result.addSuccess(self)
+        finally:
+            if profile is not None:
+                self.profile = profiler.stop(profile)
+            if recorder is not None:
+                self.dependencies = impact.stop(recorder)
+            result.stopTest(self)
+
+    def id(self):
+        if self.testcase is None:
+            return super().id()
+        cls = type(self.testcase)
+        name = self.name
+        if self.example is not None:
+            name = "%s[%d]" % (name, self.example[0])
+        return "%s.%s.%s" % (cls.__module__, cls.__qualname__, name)
 
     def __str__(self):
         return "Scenario: %s" % self.description
 
 
-class BddTest(unittest.TestCase):
+class _Rows():
+    # example rows read lazily from a file, every time it is iterated
+    def __init__(self, path, read):
+        self.path = path
+        self._read = read
+
+    def __iter__(self):
+        with open(self.path, newline="") as f:
+            yield from self._read(f)
+
+def csv_rows(path, **fmtparams):
+    return _Rows(path, lambda f: csv.DictReader(f, **fmtparams))
+
+def jsonl_rows(path):
+    return _Rows(path, lambda f: (json.loads(line) for line in f
+                                  if line.strip()))
+
+def examples(rows, batch=100):
+    # decorator which runs a scenario once per row. rows is an iterable of
+    # mappings, a function returning one (such as a generator function),
+    # or csv_rows()/jsonl_rows(). each row is given to the scenario via
+    # given(**row) and reported as a scenario of its own.
+    def decorate(method):
+        method._spicy_examples = (rows, batch)
+        return method
+    return decorate
+
+
+_PROPERTY_SEED = os.environ.get("SPICY_PROPERTY_SEED") or 0
+
+
+class _BddTestMeta(type):
+    # scenario_, bench_ and define_ tables are cached per class. setting
+    # or deleting such a method on any class bumps the generation, which
+    # drops every cached table, so dynamically added methods are found.
+    _generation = 0
+    _prefixes = ("scenario_", "bench_", "define_")
+
+    def __setattr__(cls, name, value):
+        super().__setattr__(name, value)
+        if name.startswith(_BddTestMeta._prefixes):
+            _BddTestMeta._generation += 1
+
+    def __delattr__(cls, name):
+        super().__delattr__(name)
+        if name.startswith(_BddTestMeta._prefixes):
+            _BddTestMeta._generation += 1
+
+
+class BddTest(unittest.TestCase, metaclass=_BddTestMeta):
+    # number of worker processes used to run the scenarios of this class.
+    # None falls back to the SPICY_WORKERS environment variable, and a
+    # value of 1 or less runs every scenario in this process.
+    workers = None
+
+    # "fork" runs every scenario in a forked child of the process which
+    # built the class, module and session scoped givens, so scenarios see
+    # that state copy-on-write and cannot change it for each other.
+    # None falls back to SPICY_ISOLATION, and False turns it off.
+    isolation = None
+
+    # how many `async def` scenarios of this class may run at once on a
+    # shared event loop. None falls back to SPICY_ASYNC_CONCURRENCY; with
+    # 1, each of them runs on a loop of its own, one after another.
+    async_concurrency = None
+
+    # scenarios which draw givens from strategies (integers(), lists(),
+    # ...) run over this many generated examples, spending at most
+    # property_budget seconds on generating and as many on shrinking a
+    # failure. property_workers > 1 (or SPICY_PROPERTY_WORKERS) runs the
+    # batches of both in that many processes.
+    property_examples = 100
+    property_budget = 5.0
+    property_workers = None
+
+    # runs every scenario which passed this many times more, at least
+    # five, and fails it when its retained memory or live objects keep
+    # growing from run to run. None falls back to SPICY_LEAK_CHECK, and 0
+    # turns it off. a class whose code fills caches, as some of the
+    # standard library does, may let retained memory grow by
+    # leak_allowance bytes a run (or SPICY_LEAK_ALLOWANCE); none by
+    # default, as a small leak is a leak all the same.
+    leak_check = None
+    leak_allowance = None
+
+    # with --shard, keep all the scenarios of this class on one node, for
+    # classes whose scenarios depend on each other's class scoped state
+    shard_together = False
+
+    # bench_ scenarios: where medians are stored, and by how much (a
+    # ratio) a median may grow over the stored one before the run fails.
+    # SPICY_BENCH_BASELINE and SPICY_BENCH_THRESHOLD override them, and
+    # SPICY_BENCH_UPDATE=1 stores the new medians as the baseline.
+    benchmark_baseline = ".spicy/benchmarks.json"
+    benchmark_threshold = 0.2
+
+    # where match_snapshot keeps its snapshots. SPICY_SNAPSHOT_STORE
+    # overrides it, and SPICY_SNAPSHOT_UPDATE=1 stores the values which
+    # differ instead of failing.
+    snapshot_store = ".spicy/snapshots.bin"
+
     def __init__(self, methodName='runTest'):
         super().__init__(methodName)
         #self._define_properties()
@@ -50,88 +859,1033 @@ class BddTest(unittest.TestCase):
     def runTest(self):
         pass
 
+    @classmethod
+    def _method_table(cls, prefix):
+        # returns {method name: description} for the methods starting with
+        # prefix, computed once per class and generation, from the own
+        # namespaces of the classes in the MRO, mixins included. methods
+        # added to a mixin later are only seen once a generation passes.
+        cache = cls.__dict__.get("_method_tables")
+        if cache is None or cache[0] != _BddTestMeta._generation:
+            cache = (_BddTestMeta._generation, {})
+            type.__setattr__(cls, "_method_tables", cache)
+        table = cache[1].get(prefix)
+        if table is not None:
+            return table
+
+        names = set()
+        for klass in cls.__mro__:
+            if klass is object or klass is unittest.TestCase:
+                continue
+            names.update([x for x in vars(klass) if x.startswith(prefix)])
+        table = {}
+        for name in sorted(names):
+            if prefix == 'scenario_':
+                table[name] = cls._method_name_to_scenario(name)
+            elif prefix == 'bench_':
+                table[name] = "%s (benchmark)" % (
+                    cls._method_name_to_scenario(name, prefix))
+            else:
+                table[name] = name[len(prefix):]
+        cache[1][prefix] = table
+        return table
+
     def _getTestFunctions(self):
-        prefix = 'scenario_'
-        fn = lambda x:x.startswith(prefix)
-        return [self._getTestFunction(x) for x in filter(fn, dir(self))]
+        table = self._method_table('scenario_')
+        return [self._getTestFunction(x) + (x,) for x in table]
 
     def _getTestFunction(self, method_name):
         method = getattr(self, method_name)
         if not callable(method):
-            raise TypeError('%s is not callable' % prefix + scenario)
-        return (lambda : self._run_test(method),
-                self._method_name_to_scenario(method_name))
-
-    def _method_name_to_scenario(self, name):
-        prefix = 'scenario_'
+            raise TypeError('%s is not callable' % method_name)
+        if method_name.startswith('bench_'):
+            desc = self._method_table('bench_')[method_name]
+            return (lambda scenario=None: self._run_bench(method, scenario),
+                    desc)
+        desc = self._method_table('scenario_').get(method_name)
+        if desc is None:
+            desc = self._method_name_to_scenario(method_name)
+        return (lambda scenario=None: self._run_test(method, scenario), desc)
+
+    def _make_scenario(self, method_name, example=None, fixture=None):
+        (fn, desc) = self._getTestFunction(method_name)
+        if example is not None:
+            (index, row) = example
+            desc = "%s [%d: %s]" % (desc, index, ", ".join(
+                ["%s=%s" % (k, _to_str(v)) for (k, v) in row.items()]))
+        return Scenario(fn, description=desc, name=method_name,
+                        testcase=self, example=example, fixture=fixture)
+
+    def _iter_scenarios(self):
+        # scenarios are made lazily, so that example rows are streamed
+        for name in self._method_table('scenario_'):
+            source = getattr(getattr(self, name), "_spicy_examples", None)
+            if source is None:
+                yield self._make_scenario(name)
+                continue
+            (rows, batch) = source
+            if callable(rows):
+                rows = rows()
+            fixture = None
+            for (index, row) in enumerate(rows):
+                # one fixture is allocated per batch and reset per row
+                if index % batch == 0:
+                    fixture = TestCaseFixture(self)
+                yield self._make_scenario(name, (index, row), fixture)
+        for name in self._method_table('bench_'):
+            yield self._make_scenario(name)
+
+    @staticmethod
+    def _method_name_to_scenario(name, prefix='scenario_'):
         terms = name[len(prefix):].split("_")
-        return " ".join([t[0].upper() + t[1:] for t in terms])
-
-    def _run_test(self, method):
-        f = TestCaseFixture(self)
+        return " ".join([t[0].upper() + t[1:] for t in terms if t])
+
+    def _prepare_fixture(self, f, scenario):
+        f._reset()
+        f._scenario = scenario
+        f.given(**self._define_properties())
+        if scenario is not None and scenario.example is not None:
+            f.given(**scenario.example[1])
+
+    def _begin_test(self, scenario):
+        if scenario is not None and scenario.fixture is not None:
+            f = scenario.fixture
+        else:
+            f = TestCaseFixture(self)
+        self._prepare_fixture(f, scenario)
         self.current_fixture = f
+        timing = ScenarioTiming()
+        if scenario is not None:
+            scenario.timing = timing
+        return (f, timing)
+
+    def _end_test(self, method, timing):
+        # async scenarios may overlap, so the fixture may be gone already
+        self.__dict__.pop("current_fixture", None)
+        if tracer.enabled:
+            tracer.event("scenario", scenario=method.__name__,
+                         **timing.as_dict())
+
+    def _run_test(self, method, scenario=None):
+        if inspect.iscoroutinefunction(method):
+            return self._arun_test(method, scenario)
+        (f, timing) = self._begin_test(scenario)
+        clock = time.perf_counter
+        started = clock()
         self.setUp()
+        timing.setup = clock() - started
+        try:
+            started = clock()
+            try:
+                self._call_body(method, f, scenario)
+            finally:
+                timing.body = clock() - started
+                if reporters.enabled and scenario is not None:
+                    scenario.spec = f.then._get_spec()
+                started = clock()
+                try:
+                    self.tearDown()
+                finally:
+                    f._close()
+                timing.teardown = clock() - started
+        except AssertionError as e:
+            raise ScenarioFailure(e, f) from e
+        except Exception as e:
+            debug("error: %s", e)
+            raise e from e
+        runs = self._get_leak_check()
+        if runs > 1 and not method.__name__.startswith("bench_"):
+            self._check_leaks(method, scenario, max(runs, _MIN_LEAK_RUNS))
+        self._end_test(method, timing)
+
+    def _get_leak_check(self):
+        runs = self.leak_check
+        if runs is None:
+            runs = os.environ.get("SPICY_LEAK_CHECK") or 0
+        return int(runs)
+
+    def _get_leak_allowance(self):
+        allowance = self.leak_allowance
+        if allowance is None:
+            allowance = os.environ.get("SPICY_LEAK_ALLOWANCE") or 0
+        return int(allowance)
+
+    def _check_leaks(self, method, scenario, runs):
+        # the body again on fresh fixtures, with the simplest example of
+        # givens drawn from strategies
+        def run():
+            f = TestCaseFixture(self)
+            self._prepare_fixture(f, scenario)
+            f._choices = spicy_strategies.Choices()
+            self.setUp()
+            try:
+                method(f.given, f.when, f.then)
+            finally:
+                try:
+                    self.tearDown()
+                finally:
+                    f._close()
+                    self.doCleanups()
+        growth = _check_growth(run, runs, limit=self._get_leak_allowance())
+        if growth:
+            raise ScenarioFailure("%s keeps growing: %s"
+                                  % (method.__name__, growth))
+
+    def _call_body(self, method, f, scenario):
+        # runs the body. if it drew givens from strategies, it is run over
+        # more generated examples, and a failing one is shrunk and run
+        # once more, to fail with the minimal example on f.
+        f._choices = spicy_strategies.Choices(
+            seed=lambda: self._property_seed(scenario, 0))
+        try:
+            method(f.given, f.when, f.then)
+        except unittest.SkipTest:
+            raise
+        except Exception as e:
+            if not f._choices.values:
+                raise
+            failure = (f._choices.values,
+                       "%s.%s" % (type(e).__module__, type(e).__qualname__))
+        else:
+            if not f._choices.values:
+                return
+            failure = self._explore(method, scenario)
+        if failure is None:
+            return
+        (values, error) = failure
+        values = self._shrink_failure(method, scenario, values, error)
+        self._prepare_fixture(f, scenario)
+        f._choices = spicy_strategies.Choices(values)
         try:
             method(f.given, f.when, f.then)
+        except AssertionError:
+            # ScenarioFailure shows the example
+            raise
+        except Exception as e:
+            if hasattr(e, "add_note"):
+                e.add_note("falsifying example: %s"
+                           % _fmt_drawn(f._choices.drawn))
+            raise
+        raise AssertionError("example failed with %s, but passed when "
+                             "run again" % error)
+
+    def _property_seed(self, scenario, index):
+        name = scenario.id() if scenario is not None else ""
+        return "%s:%s:%d" % (_PROPERTY_SEED, name, index)
+
+    def _get_property_workers(self):
+        workers = self.property_workers
+        if workers is None:
+            workers = os.environ.get("SPICY_PROPERTY_WORKERS") or 1
+        workers = int(workers)
+        if workers > 1 and not self._can_use_pool():
+            return 1
+        return workers
+
+    def _can_use_pool(self):
+        # pool workers are daemons, which can't have children, and get
+        # scenarios by class, which must be importable to be pickled
+        import multiprocessing
+        if multiprocessing.current_process().daemon:
+            return False
+        try:
+            pickle.dumps(type(self))
+        except Exception:
+            return False
+        return True
+
+    def _property_pool(self):
+        workers = self._get_property_workers()
+        if workers <= 1:
+            return None
+        import multiprocessing
+        import concurrent.futures
+        return concurrent.futures.ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("fork"))
+
+    def _explore(self, method, scenario):
+        # (choices, error) of a failing example among property_examples
+        # generated ones, run in batches, in parallel with
+        # property_workers, until property_budget seconds are spent
+        seeds = [self._property_seed(scenario, i)
+                 for i in range(1, self.property_examples)]
+        # one deadline for every batch; workers stop at it too
+        deadline = time.monotonic() + self.property_budget
+        pool = self._property_pool()
+        if pool is None:
+            return _run_examples(self, method, scenario, seeds, deadline)
+        batch = max(1, len(seeds) // (pool._max_workers * 4))
+        name = method.__name__
+        example = scenario.example if scenario is not None else None
+        try:
+            futures = [pool.submit(_property_worker, type(self), name,
+                                   example, _run_examples,
+                                   seeds[i:i + batch], deadline)
+                       for i in range(0, len(seeds), batch)]
+            # the first failing batch in seed order, to be deterministic
+            for future in futures:
+                failure = future.result()
+                if failure is not None:
+                    return failure
+            return None
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def _shrink_failure(self, method, scenario, values, error):
+        deadline = time.monotonic() + self.property_budget
+        pool = self._property_pool()
+        if pool is None:
+            def replay(candidates):
+                return _replay_examples(self, method, scenario, candidates,
+                                        error)
+            return spicy_strategies.shrink(values, replay, 1, deadline)
+
+        name = method.__name__
+        example = scenario.example if scenario is not None else None
+        workers = pool._max_workers
+        def replay(candidates):
+            # one candidate per task; the first failing one in order wins
+            futures = [pool.submit(_property_worker, type(self), name,
+                                   example, _replay_examples, [x], error)
+                       for x in candidates]
+            for future in futures:
+                smaller = future.result()
+                if smaller is not None:
+                    return smaller
+            return None
+        try:
+            return spicy_strategies.shrink(values, replay, workers * 2, deadline)
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    async def _arun_test(self, method, scenario=None):
+        # the same as _run_test, for `async def scenario_*` methods.
+        # asyncSetUp and asyncTearDown are awaited when they are defined.
+        (f, timing) = self._begin_test(scenario)
+        clock = time.perf_counter
+        started = clock()
+        self.setUp()
+        if hasattr(self, "asyncSetUp"):
+            await self.asyncSetUp()
+        timing.setup = clock() - started
+        try:
+            started = clock()
+            try:
+                await method(f.given, f.when, f.then)
+            finally:
+                timing.body = clock() - started
+                if reporters.enabled and scenario is not None:
+                    scenario.spec = f.then._get_spec()
+                started = clock()
+                try:
+                    if hasattr(self, "asyncTearDown"):
+                        await self.asyncTearDown()
+                    self.tearDown()
+                finally:
+                    f._close()
+                timing.teardown = clock() - started
         except AssertionError as e:
-            self.tearDown()
             raise ScenarioFailure(e, f) from e
         except Exception as e:
-            self.tearDown()
-            debug("error: %s" % e)
+            debug("error: %s", e)
             raise e from e
-        self.tearDown()
-        del self.current_fixture
+        self._end_test(method, timing)
+
+    def _run_bench(self, method, scenario=None):
+        # runs the body once to record given/when, then measures the
+        # recorded 'when' chain and checks it against the stored baseline
+        import spicy_bench
+        if os.environ.get("SPICY_SKIP_BENCH"):
+            raise unittest.SkipTest("benchmarks are disabled")
+        stats = {}
+        def body(given, when, then):
+            method(given, when, then)
+            when._eval()
+            # measured as the baseline was, without the call recorder of
+            # impact selection or a profiler slowing every call down
+            paused = [x for x in (impact, profiler) if x is not None]
+            for x in paused:
+                x.pause()
+            try:
+                stats.update(spicy_bench.run_calibrated(when._repeat()))
+            finally:
+                for x in paused:
+                    x.resume()
+            stats["spec"] = when._get_spec()
+        body.__name__ = method.__name__
+        self._run_test(body, scenario)
+
+        spec = stats.pop("spec")
+        name = scenario.id() if scenario else method.__name__
+        path = os.environ.get("SPICY_BENCH_BASELINE")
+        store = spicy_bench.BaselineStore.open(path or self.benchmark_baseline)
+        threshold = float(os.environ.get("SPICY_BENCH_THRESHOLD")
+                          or self.benchmark_threshold)
+        baseline = store.get(name)
+        if baseline is None or os.environ.get("SPICY_BENCH_UPDATE"):
+            store.put(name, stats)
+            return
+        if stats["median"] > baseline["median"] * (1 + threshold):
+            msg = "when %s: median %s > baseline %s by %.1f%% (%s)" % (
+                spec, _fmt_seconds(stats["median"]),
+                _fmt_seconds(baseline["median"]),
+                (stats["median"] / baseline["median"] - 1) * 100,
+                "threshold %.0f%%" % (threshold * 100))
+            raise ScenarioFailure(msg)
 
     def run(self, result=None):
         if not result:
             result = self.defaultTestResult()
 
         # run test
-        tests = [Scenario(fn, description=desc)
-                 for (fn, desc)
-                 in self._getTestFunctions()]
-        if not tests:
+        tests = self._iter_scenarios()
+        sharded = sharding is not None and not sharding.busy
+        if sharded:
+            key = None
+            if self.shard_together:
+                key = "%s.%s" % (type(self).__module__,
+                                 type(self).__qualname__)
+            tests = sharding.select(tests, key)
+        selected = impact is not None and not impact.busy
+        if selected:
+            tests = impact.select(tests)
+        reported = reporters.enabled and not reporters.busy
+        first = next(tests, None)
+        if first is None:
             return result
-        suite = unittest.TestSuite(tests)
+        tests = itertools.chain([first], tests)
+        _Scopes.enter_module(type(self).__module__)
         self.setUpClass()
-        suite.run(BddTestResult(result))
+        if sharded:
+            # suites run by scenarios are not split again
+            sharding.busy = True
+        if selected:
+            impact.busy = True
+        if reported:
+            reporters.busy = True
+        try:
+            workers = self._get_workers()
+            bdd_result = BddTestResult(result, selected, reported)
+            if self._get_isolation() == "fork":
+                self._run_forked(tests, bdd_result, workers)
+            elif workers > 1 and self._can_use_pool():
+                self._run_parallel(tests, bdd_result, workers)
+            elif self._get_async_concurrency() > 1:
+                import asyncio
+                asyncio.run(self._run_concurrent(
+                    tests, bdd_result, self._get_async_concurrency()))
+            else:
+                self._run_serial(tests, bdd_result)
+        finally:
+            if sharded:
+                sharding.busy = False
+            if selected:
+                impact.busy = False
+            if reported:
+                reporters.busy = False
+            self._get_class_scope().close()
+            _flush_snapshots()
         self.tearDownClass()
         return result
 
+    def _get_class_scope(self):
+        scope = self.__dict__.get("_class_scope")
+        if scope is None:
+            scope = self._class_scope = _Scope()
+        return scope
+
+    def _run_serial(self, tests, result):
+        for test in tests:
+            if result.shouldStop:
+                break
+            test(result)
+
+    def _get_workers(self):
+        workers = self.workers
+        if workers is None:
+            workers = os.environ.get("SPICY_WORKERS") or 1
+        return int(workers)
+
+    def _get_async_concurrency(self):
+        limit = self.async_concurrency
+        if limit is None:
+            limit = os.environ.get("SPICY_ASYNC_CONCURRENCY") or 1
+        # a suite run from a scenario on a loop can't start another. with
+        # asyncio not imported yet, no loop is running.
+        asyncio = sys.modules.get("asyncio")
+        if asyncio is not None:
+            try:
+                asyncio.get_running_loop()
+                return 1
+            except RuntimeError:
+                pass
+        return int(limit)
+
+    async def _run_concurrent(self, tests, result, limit):
+        # async scenarios are started as tasks, at most `limit` at once;
+        # sync ones run in turn. outcomes are replayed in discovery order.
+        import asyncio
+        semaphore = asyncio.Semaphore(limit)
+        async def run(test):
+            async with semaphore:
+                recorder = _OutcomeRecorder()
+                await test.arun(recorder)
+                return recorder.outcome
+
+        pending = collections.deque()
+        for test in tests:
+            if result.shouldStop:
+                break
+            pending.append((test, asyncio.ensure_future(run(test))))
+            while pending and (len(pending) > limit * 4
+                               or pending[0][1].done()):
+                (test, task) = pending.popleft()
+                (await task).replay(test, result)
+        while pending:
+            (test, task) = pending.popleft()
+            outcome = await task
+            if not result.shouldStop:
+                outcome.replay(test, result)
+
+    def _get_isolation(self):
+        isolation = self.isolation
+        if isolation is None:
+            isolation = os.environ.get("SPICY_ISOLATION")
+        if isolation == "fork" and not hasattr(os, "fork"):
+            return None
+        return isolation
+
+    def _run_forked(self, tests, result, workers):
+        # build the shared givens here, once, before any child is forked
+        f = TestCaseFixture(self)
+        for factory in self._define_properties().values():
+            if factory.scope != "scenario":
+                f._get_scope(factory.scope).get(factory)
+        pending = collections.deque()
+        for test in tests:
+            if result.shouldStop:
+                break
+            pending.append((test,) + self._fork_scenario(test))
+            if len(pending) >= workers:
+                self._reap_next(pending, result)
+        while pending:
+            self._reap_next(pending, result)
+
+    def _fork_scenario(self, test):
+        # buffered output would otherwise be written by both processes
+        sys.stdout.flush()
+        sys.stderr.flush()
+        tracer.flush()
+        _flush_snapshots()
+        (r, w) = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(w)
+            return (pid, r)
+
+        # child: run the scenario and send its outcome to the parent
+        os.close(r)
+        status = 1
+        try:
+            recorder = _OutcomeRecorder()
+            test.run(recorder)
+            with os.fdopen(w, "wb") as f:
+                f.write(pickle.dumps(recorder.outcome))
+            _flush_snapshots()
+            status = 0
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            tracer.flush()
+            os._exit(status)
+
+    def _reap_next(self, pending, result):
+        (test, pid, fd) = pending.popleft()
+        with os.fdopen(fd, "rb") as f:
+            data = f.read()
+        (_, status) = os.waitpid(pid, 0)
+        if result.shouldStop:
+            return
+        if data:
+            outcome = pickle.loads(data)
+        else:
+            outcome = ScenarioOutcome(
+                "error", "scenario process exited with status %d"
+                % os.waitstatus_to_exitcode(status))
+        outcome.replay(test, result)
+
+    def _run_parallel(self, tests, result, workers):
+        # prefer fork so that workers inherit the state made by setUpClass
+        # and test classes defined in __main__ stay importable.
+        import multiprocessing
+        import concurrent.futures
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        _flush_snapshots()
+        with concurrent.futures.ProcessPoolExecutor(workers, context) as pool:
+            # scenarios are submitted through a bounded window, so that
+            # streamed examples are never all held in memory
+            pending = collections.deque()
+            for test in tests:
+                if result.shouldStop:
+                    break
+                future = pool.submit(_run_scenario_in_worker, type(self),
+                                     test.name, test.example)
+                pending.append((test, future))
+                if len(pending) >= workers * 4:
+                    self._replay_next(pending, result)
+            while pending:
+                self._replay_next(pending, result)
+
+    def _replay_next(self, pending, result):
+        # replay in discovery order to keep the report stable
+        (test, future) = pending.popleft()
+        if result.shouldStop:
+            future.cancel()
+            return
+        try:
+            outcome = future.result()
+        except Exception as e:
+            outcome = ScenarioOutcome("error", str(e))
+        outcome.replay(test, result)
+
     def _define_properties(self):
+        # define_<name> methods become given.<name>, built lazily by a
+        # Factory. they live as long as the class run unless the method
+        # is decorated with @scoped(...).
+        properties = self.__dict__.get("_properties")
+        if properties is not None:
+            return properties
         self._properties = {}
-        prefix = 'define_'
-        fn = lambda x:x.startswith(prefix)
-        for method_name in filter(fn, dir(self)):
+        table = self._method_table('define_')
+        for (method_name, property_name) in table.items():
             method = getattr(self, method_name)
-            property_name = method_name[len(prefix):]
             if not property_name:
                 continue
             if not callable(method):
                 raise TypeError('%s is not callable' % method_name)
-            self._properties[property_name] = method()
+            scope = getattr(method, "_spicy_scope", "class")
+            self._properties[property_name] = Factory(
+                method, scope, key=(type(self), method_name))
+        return self._properties
 
 
 class BddTestResult():
-    def __init__(self, result):
+    def __init__(self, result, record_impact=False, report=False):
         self._result = result
+        # whether scenarios are recorded in the impact index and written
+        # to the reporters. suites run by scenarios are not, they are part
+        # of the outer scenario.
+        self._record_impact = record_impact
+        self._report = report
+        # timings are kept on the wrapped result, so that they add up
+        # over every BddTest class run with it
+        if getattr(result, "scenario_timings", None) is None:
+            result.scenario_timings = ScenarioTimings(self.slowest_kept)
+        if not isinstance(result.failures, _CappedList):
+            result.failures = _CappedList(result.failures, self.max_failures)
+            result.errors = _CappedList(result.errors, self.max_failures)
 
     def __getattr__(self, key):
         return getattr(self._result, key)
 
+    @property
+    def timings(self):
+        return self._result.scenario_timings
+
+    def stopTest(self, test):
+        timing = getattr(test, "timing", None)
+        if timing is not None:
+            self.timings.add(test.id(), test.description, timing)
+        dependencies = getattr(test, "dependencies", None)
+        if self._record_impact and dependencies is not None:
+            impact.record(test.id(), dependencies)
+        profile = getattr(test, "profile", None)
+        if profile is not None and profiler is not None:
+            profiler.record(test.id(), profile)
+        self._result.stopTest(test)
+
+    # failures and errors past this many are only counted; the reporters
+    # have them all
+    max_failures = int(os.environ.get("SPICY_MAX_FAILURES") or 100)
+    # how many of the slowest timings are kept, for --slowest
+    slowest_kept = 10
+
     def addFailure(self, test, err):
         (t, v, trace) = err
-        formatted_err = v
+        # rendered now, so that the fixture of the failure can be freed
+        formatted_err = str(v)
+        if impact is not None:
+            impact.mark_failed(test.id())
+        if self._report:
+            reporters.report(test, "failure", formatted_err)
         self.failures.append((test, formatted_err))
         print("FAIL")
 
+    def addError(self, test, err):
+        if impact is not None:
+            impact.mark_failed(test.id())
+        formatted_err = _format_error(self._result, test, err)
+        if self._report:
+            reporters.report(test, "error", formatted_err)
+        self._result.addError(test, err)
+        if self.errors and self.errors[-1][0] is test:
+            self.errors[-1] = (test, formatted_err)
+
+    def addSuccess(self, test):
+        if self._report:
+            reporters.report(test, "success")
+        self._result.addSuccess(test)
+
+    def addSkip(self, test, reason):
+        if self._report:
+            reporters.report(test, "skip", reason)
+        self._result.addSkip(test, reason)
+
+class _CappedList(list):
+    # the failures or errors of a result. past `cap` entries they are
+    # only counted; len() is the full count, as the summary of the
+    # runner and wasSuccessful want it.
+    def __init__(self, items, cap):
+        super().__init__(items)
+        self.cap = cap
+        self.left_out = 0
+
+    def append(self, item):
+        if list.__len__(self) < self.cap:
+            super().append(item)
+        else:
+            self.left_out += 1
+
+    def __len__(self):
+        return list.__len__(self) + self.left_out
+
+
+class ScenarioTimings():
+    # the timings a BddTestResult saw: how many, and the `keep` slowest
+    # in a bounded heap. iterates over (id, description, timing), the
+    # slowest first.
+    def __init__(self, keep=10):
+        self.keep = keep
+        self.count = 0
+        self._heap = []
+
+    def add(self, test_id, description, timing):
+        self.count += 1
+        entry = (timing.total, self.count, test_id, description, timing)
+        if len(self._heap) < self.keep:
+            heapq.heappush(self._heap, entry)
+        elif entry[0] > self._heap[0][0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for entry in sorted(self._heap, reverse=True):
+            yield entry[2:]
+
+
+def slowest_scenarios(timings, n=10):
+    # timings is what BddTestResult keeps, or a list of (id, description,
+    # timing)
+    return heapq.nlargest(n, timings, key=lambda x: x[2].total)
+
+def print_slowest(timings, n=10, stream=None):
+    stream = stream or sys.stderr
+    slowest = slowest_scenarios(timings, n)
+    if not slowest:
+        return
+    print("\nSlowest %d scenarios:" % len(slowest), file=stream)
+    for (test_id, desc, timing) in slowest:
+        print("  %9.4fs  %s (setUp %.4fs, body %.4fs, tearDown %.4fs)"
+              % (timing.total, test_id, timing.setup or 0,
+                 timing.body or 0, timing.teardown or 0), file=stream)
+
+def load_timings(path):
+    # returns {scenario id: total seconds} from a file of TimingsReporter
+    with open(path) as f:
+        data = json.load(f)
+    return dict([(x["id"], x["total"]) for x in data["scenarios"]])
+
+
+class Sharding():
+    # picks the scenarios of one of `count` CI nodes (index is 1 based).
+    # every node makes the same choices without talking to the others:
+    # classes run in the same order everywhere and the load of each shard
+    # carries over from one class to the next.
+    #
+    # scenarios with a duration in the timings history are placed longest
+    # first on the least loaded shard. the others go to a shard chosen by
+    # a hash of their id, which keeps them in place when scenarios are
+    # added or removed, and count as the mean known duration.
+    def __init__(self, index, count, durations=None):
+        if not 1 <= index <= count:
+            raise ValueError("shard %d is not in 1..%d" % (index, count))
+        self.index = index - 1
+        self.count = count
+        self.durations = durations or {}
+        self.loads = [0.0] * count
+        self.busy = False
+        if self.durations:
+            self.estimate = sum(self.durations.values()) / len(self.durations)
+        else:
+            self.estimate = 1.0
+
+    @classmethod
+    def parse(cls, spec, timings=None):
+        # "3/16" and an optional file written by TimingsReporter
+        (index, _, count) = spec.partition("/")
+        durations = None
+        if timings and os.path.exists(timings):
+            durations = load_timings(timings)
+        return cls(int(index), int(count), durations)
+
+    @classmethod
+    def from_env(cls):
+        spec = os.environ.get("SPICY_SHARD")
+        if not spec:
+            return None
+        return cls.parse(spec, os.environ.get("SPICY_SHARD_TIMINGS"))
+
+    def select(self, tests, key=None):
+        # yields the tests of this shard. it must run to the end, even on
+        # a node which gets none of them, to keep the loads in step. with
+        # a key, all the tests go to one shard as a single unit.
+        if key is not None:
+            units = [(key, list(tests))]
+        else:
+            units = ((test.id(), (test,)) for test in tests)
+        known = []
+        for (unit_id, unit) in units:
+            durations = [self.durations.get(test.id()) for test in unit]
+            if None in durations:
+                shard = zlib.crc32(unit_id.encode()) % self.count
+                self.loads[shard] += self.estimate * len(unit)
+                if shard == self.index:
+                    yield from unit
+            else:
+                known.append((sum(durations), unit_id, unit))
+        known.sort(key=lambda x: (-x[0], x[1]))
+        heap = [(load, i) for (i, load) in enumerate(self.loads)]
+        heapq.heapify(heap)
+        for (duration, unit_id, unit) in known:
+            (load, shard) = heapq.heappop(heap)
+            heapq.heappush(heap, (load + duration, shard))
+            self.loads[shard] = load + duration
+            if shard == self.index:
+                yield from unit
+
+sharding = Sharding.from_env()
+
+
+class _CallRecorder():
+    # collects the code objects which run between start() and stop(),
+    # with sys.monitoring where there is one and sys.settrace before.
+    # only calls are seen, never lines, so the overhead stays small.
+    def __init__(self):
+        self.codes = set()
+
+    if hasattr(sys, "monitoring"):
+        def start(self):
+            monitoring = sys.monitoring
+            tool = monitoring.COVERAGE_ID
+            if monitoring.get_tool(tool) is not None:
+                return False
+            monitoring.use_tool_id(tool, "spicy_bdd")
+            monitoring.register_callback(tool, monitoring.events.PY_START,
+                                         self._started)
+            monitoring.set_events(tool, monitoring.events.PY_START)
+            monitoring.restart_events()
+            return True
+
+        def pause(self):
+            sys.monitoring.set_events(sys.monitoring.COVERAGE_ID, 0)
+
+        def resume(self):
+            sys.monitoring.set_events(sys.monitoring.COVERAGE_ID,
+                                      sys.monitoring.events.PY_START)
+
+        def _started(self, code, offset):
+            self.codes.add(code)
+            # each code object is reported once per recording
+            return sys.monitoring.DISABLE
+
+        def stop(self):
+            tool = sys.monitoring.COVERAGE_ID
+            sys.monitoring.set_events(tool, 0)
+            sys.monitoring.free_tool_id(tool)
+    else:
+        def start(self):
+            # a debugger or coverage tool is in charge already
+            if sys.gettrace() is not None:
+                return False
+            sys.settrace(self._trace)
+            return True
+
+        def pause(self):
+            sys.settrace(None)
+
+        def resume(self):
+            sys.settrace(self._trace)
+
+        def _trace(self, frame, event, arg):
+            if event == "call":
+                self.codes.add(frame.f_code)
+            return None
+
+        def stop(self):
+            sys.settrace(None)
+
+
+class ImpactIndex():
+    # test impact selection. every scenario which runs records the
+    # source files it executed code from; the next run skips the ones
+    # whose files all still have the same content hash and which did not
+    # fail last time. scenarios never recorded always run.
+    #
+    # the index is a json file: {"scenarios": {id: {"files": {path:
+    # [functions]}, "hashes": {path: sha1}, "failed": bool}}}. hashes are
+    # kept per scenario, so that a scenario left out of one run (by -k or
+    # --shard) still sees the changes made before it runs again.
+    def __init__(self, path, load=True):
+        self.path = path
+        self._recorder = None
+        self._recording = 0
+        self._hashes = {}
+        self._ignored = tuple(set([sysconfig.get_path("stdlib"),
+                                   sysconfig.get_path("platstdlib")]))
+        data = {}
+        if load:
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                pass
+        self._scenarios = data.get("scenarios", {})
+        self._failed = set()
+        self.busy = False
+
+    @classmethod
+    def from_env(cls):
+        if not os.environ.get("SPICY_IMPACT"):
+            return None
+        return cls(os.environ.get("SPICY_IMPACT_INDEX")
+                   or ".spicy/impact.json")
+
+    def _hash(self, path):
+        digest = self._hashes.get(path)
+        if digest is None:
+            try:
+                with open(path, "rb") as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()
+            except OSError:
+                digest = ""
+            self._hashes[path] = digest
+        return digest
+
+    def refresh(self):
+        # for a process which runs the suite again: files may have
+        # changed since they were hashed
+        self._hashes = {}
+        self._failed = set()
+
+    def affected(self, test_id):
+        entry = self._scenarios.get(test_id)
+        if entry is None or entry["failed"]:
+            return True
+        for (path, digest) in entry["hashes"].items():
+            if digest != self._hash(path):
+                return True
+        return False
+
+    def select(self, tests):
+        for test in tests:
+            if self.affected(test.id()):
+                yield test
+
+    def start(self):
+        # returns a recorder, or None if calls can't be recorded. scenarios
+        # which overlap, as async ones or suites run by a scenario do,
+        # share one recorder and each gets all the calls seen until it
+        # stops: more files than it needs, but never fewer.
+        if self._recorder is None:
+            recorder = _CallRecorder()
+            if not recorder.start():
+                return None
+            self._recorder = recorder
+        self._recording += 1
+        return self._recorder
+
+    def pause(self):
+        # while a scenario measures itself, as bench_ scenarios do
+        if self._recorder is not None:
+            self._recorder.pause()
+
+    def resume(self):
+        if self._recorder is not None:
+            self._recorder.resume()
+
+    def stop(self, recorder):
+        self._recording -= 1
+        if not self._recording:
+            recorder.stop()
+            self._recorder = None
+        files = {}
+        for code in list(recorder.codes):
+            path = code.co_filename
+            if path.startswith("<") or path.startswith(self._ignored):
+                continue
+            files.setdefault(path, set()).add(code.co_qualname
+                                              if hasattr(code, "co_qualname")
+                                              else code.co_name)
+        return dict([(os.path.relpath(path), sorted(names))
+                     for (path, names) in files.items()])
+
+    def mark_failed(self, test_id):
+        self._failed.add(test_id)
+
+    def record(self, test_id, dependencies):
+        self._scenarios[test_id] = {
+            "files": dependencies,
+            "hashes": dict([(path, self._hash(path))
+                            for path in dependencies]),
+            "failed": test_id in self._failed}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump({"scenarios": self._scenarios}, f, indent=1,
+                      sort_keys=True)
+        os.replace(tmp, self.path)
+
+impact = ImpactIndex.from_env()
+if impact is not None:
+    atexit.register(impact.save)
+
+# a spicy_profile.SuiteProfile in profiling mode
+profiler = None
+if os.environ.get("SPICY_PROFILE"):
+    import spicy_profile
+    profiler = spicy_profile.SuiteProfile.from_env()
+    atexit.register(profiler.save)
+
 
 class Fixture(object):
     def __init__(self):
         self._given = Given(self)
         self._when = When(self)
         self._then = Then(self)
+        self._scope = _Scope()
+        # the choice sequence of givens drawn from strategies
+        self._choices = None
+        # the running scenario, and the number of snapshots it matched
+        self._scenario = None
+        self._snapshots = 0
 
     @property
     def given(self):
@@ -145,6 +1899,39 @@ class Fixture(object):
     def then(self):
         return self._then
 
+    def _get_scope(self, scope):
+        if scope == "session":
+            return _Scopes.session
+        if scope == "module":
+            return _Scopes.module
+        # without a test case, class scope is as long as the fixture
+        return self._scope
+
+    def _close(self):
+        self._scope.close()
+
+    def _draw(self, name, strategy):
+        choices = self._choices
+        if choices is None:
+            # outside of a property run, a single random example
+            choices = self._choices = spicy_strategies.Choices(rng=random.Random())
+        value = strategy.draw(choices)
+        choices.drawn.append((name, value))
+        return value
+
+    def _reset(self):
+        # makes the fixture ready for another scenario without
+        # allocating new given/when/then objects
+        self._scope.close()
+        self._given._dict = {}
+        self._when._stack = []
+        self._when._spec = []
+        self._when._executed = False
+        self._then._clear()
+        self._then._cursor = None
+        self._choices = None
+        self._snapshots = 0
+
 
 class TestCaseFixture(Fixture):
     def __init__(self, testcase):
@@ -154,6 +1941,120 @@ class TestCaseFixture(Fixture):
     def __getattr__(self, key):
         return getattr(self._testcase, key)
 
+    def _get_scope(self, scope):
+        if scope == "class":
+            return self._testcase._get_class_scope()
+        return super()._get_scope(scope)
+
+
+class Factory():
+    # a given value which is built when it is first used, and memoized
+    # for the lifetime of its scope. fn is called without arguments; if
+    # it is a generator function, the first value it yields is used and
+    # the generator is finished when the scope ends.
+    SCOPES = ("scenario", "class", "module", "session")
+
+    def __init__(self, fn, scope="scenario", teardown=None, key=None):
+        if scope not in Factory.SCOPES:
+            raise ValueError("unknown scope: %s" % scope)
+        self.fn = fn
+        self.scope = scope
+        self.teardown = teardown
+        self.key = _factory_key(fn, scope, teardown) if key is None else key
+
+    def _build(self, scope):
+        value = self.fn()
+        if inspect.isgenerator(value):
+            gen = value
+            value = next(gen)
+            scope.finalizers.append(lambda: next(gen, None))
+        if self.teardown is not None:
+            scope.finalizers.append(lambda: self.teardown(value))
+        return value
+
+def _factory_key(fn, scope, teardown):
+    # factories made inline, by given(x=factory(fn, ...)) in a scenario
+    # body, share their value with the ones made by the other runs of
+    # it. a lambda is a new function every run, so functions which only
+    # differ by identity, capturing nothing, are keyed by their code.
+    def identity(fn):
+        if isinstance(fn, types.FunctionType) and fn.__closure__ is None \
+           and not fn.__defaults__ and not fn.__kwdefaults__:
+            return fn.__code__
+        return fn
+    return ("factory", identity(fn), scope, identity(teardown))
+
+def factory(fn, scope="scenario", teardown=None):
+    return Factory(fn, scope, teardown)
+
+def scoped(scope):
+    # decorator which sets the scope of a define_ method
+    def decorate(method):
+        method._spicy_scope = scope
+        return method
+    return decorate
+
+
+class _Scope():
+    # values built by factories and their finalizers, for one lifetime
+    def __init__(self):
+        self.values = {}
+        self.finalizers = []
+
+    def get(self, factory):
+        value = self.values.get(factory.key, _NOTHING)
+        if value is _NOTHING:
+            value = self.values[factory.key] = factory._build(self)
+        return value
+
+    def close(self):
+        self.values.clear()
+        while self.finalizers:
+            self.finalizers.pop()()
+
+
+def _flush_snapshots():
+    # new snapshots of this process, written before it forks so that the
+    # children don't write them again
+    snapshots = sys.modules.get("spicy_snapshot")
+    if snapshots is not None:
+        snapshots.SnapshotStore.flush_all()
+
+def _snapshot_owner(fixture):
+    # the id of the scenario, its module replaced by the path of its file
+    # from the working directory, which doesn't depend on whether the
+    # module was run as __main__ or imported
+    scenario = fixture._scenario
+    owner = scenario.id() if scenario is not None else fixture.id()
+    name = type(getattr(fixture, "_testcase", fixture)).__module__
+    path = getattr(sys.modules.get(name), "__file__", None)
+    prefix = name + "."
+    if path is None or not owner.startswith(prefix):
+        return owner
+    path = os.path.relpath(path).replace(os.sep, "/")
+    return "%s:%s" % (path, owner[len(prefix):])
+
+
+class _Scopes():
+    # module and session scopes. a module scope is closed when a BddTest
+    # of another module starts to run, and everything is closed at exit.
+    session = _Scope()
+    module = _Scope()
+    module_name = None
+
+    @classmethod
+    def enter_module(cls, name):
+        if name != cls.module_name:
+            cls.module.close()
+            cls.module_name = name
+
+    @classmethod
+    def close(cls):
+        cls.module.close()
+        cls.session.close()
+
+atexit.register(_Scopes.close)
+
 
 class Given():
     def __init__(self, fixture):
@@ -161,47 +2062,82 @@ class Given():
         self._dict = {}
 
     def __call__(self, **kwargs):
+        # given() is called a lot; strategies are only looked for once
+        # there are some, and then in C
+        types = spicy_strategies.Strategy.types
+        if spicy_strategies.Strategy.created and not types.isdisjoint(
+                map(type, kwargs.values())):
+            for (key, value) in kwargs.items():
+                if type(value) in types:
+                    kwargs[key] = self._fixture._draw(key, value)
         self._dict.update(kwargs)
 
     def __getattr__(self, key):
         v = self._dict[key]
+        if v.__class__ is Factory:
+            v = self._resolve(key, v)
         return Given.Value(key, v)
 
     def __getitem__(self, key):
         v = self._dict[key]
+        if v.__class__ is Factory:
+            v = self._resolve(key, v)
         return Given.Value(key, v)
 
+    def _resolve(self, key, factory):
+        value = self._fixture._get_scope(factory.scope).get(factory)
+        # later lookups in this scenario see the value itself
+        self._dict[key] = value
+        return value
+
     class Value():
+        __slots__ = ("_name", "value")
+
         def __init__(self, name, value):
-            self.name = name
+            self._name = name
             self.value = value
 
+        @property
+        def name(self):
+            # nested names are kept as spec tokens until someone asks
+            return _render_spec((self._name,))
+
         def __getitem__(self, index):
-            name = "%s[%s]" % (self.name, _to_str(index))
+            name = (_fmt_given_item, (self._name, index))
             return Given.Value(name, self.value[index])
 
         def __getattr__(self, name):
-            new_name = "%s.%s" % (self.name, name)
+            new_name = (_fmt_given_attr, (self._name, name))
             return Given.Value(new_name, getattr(self.value, name))
 
 
 class When():
+    # compiled plans, keyed by the call site which started the chain
+    _plans = {}
+    _max_plans = 4096
+
     def __init__(self, fixture):
         self._fixture = fixture
         self._stack = []
         self._executed = False
-        self._spec = ""
+        self._spec = []
+        self._site = None
 
         self._this = None
         self._spec_stack = []
 
     def __getattr__(self, key):
-        debug("when.__getattr__(%s)" % key)
+        if tracer.enabled:
+            debug("when.__getattr__(%s)", key)
         t = When.Term(self, key)
         self._stack.clear()
-        self._spec = ""
+        self._spec = []
         self._executed = False
         self._stack.append(t)
+        # the frame which wrote `when.<key>` identifies the call site.
+        # code objects hash by value, so their id is used as the key.
+        f = sys._getframe(1)
+        self._site = (id(f.f_code), f.f_lasti, f.f_code)
         return t
 
     def _eval(self):
@@ -209,70 +2145,169 @@ class When():
             debug("'when' stack is already executed. skip.")
             return
 
-        this = None
-        spec = []
         given = self._fixture.given
-        debug("start execution 'when' stack...")
-        debug("'when' stack: %s" % self._stack)
-        debug("'given' stack: %s" % given._dict)
-        for term in self._stack:
-            debug("term: %s, this: %s" % (term._name, this))
-            if term._name == "_and":
-                spec.append("and")
-                continue
-            if this is not None:
-                p = getattr(this, term._name)
-            else:
-                # no current item, so get from given values
-                try:
-                    p = given[term._name].value
-                except KeyError as err:
-                    raise AttributeError(err)
-
-            # if term is not callable, process next term
-            if not term._callable:
-                this = p
-                spec.append(term._name)
-                continue
-            # call the function
-            arg_names = []
-            # convert arguments list
-            args = []
-            if term._args:
-                for i in term._args:
-                    if isinstance(i, Given.Value):
-                        args.append(i.value)
-                        arg_names.append(_to_str(i.value))
-                    else:
-                        args.append(i)
-                        arg_names.append(_to_str(i))
-                        
-            # convert keywork arguments
-            kwargs = {}
-            if term._kwargs:
-                for i in term._kwargs.keys():
-                    if isinstance(i, Given.Value):
-                        kwargs[i] = term._kwargs[i].value
-                        arg_names.append("%s=%s" % (i, _to_str(term._kwargs[i].value)))
-                    else:
-                        kwargs[i] = term._kwargs[i]
-                        arg_names.append("%s=%s" % (i, _to_str(term._kwargs[i])))
-            # call and append
-            p = p(*args, **kwargs)
-            spec.append("%s(%s)" % (term._name, ", ".join(arg_names)))
-            this = p
+        if tracer.enabled:
+            debug("start execution 'when' stack...")
+            debug("'when' stack: %s", self._stack)
+            debug("'given' stack: %s", _to_str(given._dict))
+        plan = self._get_plan()
+        try:
+            (p, spec, _) = plan.run(self._stack, given)
+        except When.Plan.Mismatch:
+            # the same call site recorded a different chain this time
+            plan = self._get_plan(compile=True)
+            (p, spec, _) = plan.run(self._stack, given)
+        self._it = p
+        self._spec = spec
+        self._executed = True
+        if tracer.enabled:
+            debug("finish execution 'when' stack.")
+            debug("'when' spec is: %s", self._get_spec())
+            debug("'it' is: %s", _to_str(self._it))
+
+    async def _aeval(self):
+        # evaluates the chain like _eval, awaiting every awaitable which
+        # a call returns before the next term is applied to it
+        if self._executed:
+            return self._it
+        given = self._fixture.given
+        plan = self._get_plan()
+        try:
+            (p, spec, resume) = plan.run(self._stack, given, pause=True)
+        except When.Plan.Mismatch:
+            plan = self._get_plan(compile=True)
+            (p, spec, resume) = plan.run(self._stack, given, pause=True)
+        while resume is not None:
+            p = await p
+            (p, spec, resume) = plan.run(self._stack, given, resume, p, spec,
+                                         pause=True)
         self._it = p
-        self._spec = " ".join(spec)
+        self._spec = spec
         self._executed = True
-        debug("finish execution 'when' stack.")
-        debug("'when' spec is: %s" % self._fixture.when._spec)
-        debug("'it' is: %s" % self._it)
+        return p
+
+    def _get_plan(self, compile=False):
+        plans = When._plans
+        site = self._site
+        if site is None:
+            return When.Plan(self._stack)
+        key = site[:2]
+        entry = None if compile else plans.get(key)
+        if entry is None or entry[0] is not site[2]:
+            entry = (site[2], When.Plan(self._stack))
+            if len(plans) >= When._max_plans:
+                plans.clear()
+            plans[key] = entry
+        return entry[1]
+
+    class Plan():
+        # a recorded chain compiled to a flat list of ops. names, the
+        # kind of every term (and / lookup in given / attribute of the
+        # previous value) and whether it is called are resolved once, so
+        # running the plan again only pays for the calls themselves.
+        AND = 0
+        GIVEN = 1
+        ATTR = 2
+
+        class Mismatch(Exception):
+            pass
+
+        def __init__(self, stack):
+            ops = []
+            kind = When.Plan.GIVEN
+            for term in stack:
+                if term._name == "_and":
+                    ops.append((When.Plan.AND, term._name, False))
+                    kind = When.Plan.GIVEN
+                    continue
+                ops.append((kind, term._name, term._callable))
+                kind = When.Plan.ATTR
+            self._ops = tuple(ops)
+
+        def run(self, stack, given, start=0, this=None, spec=None,
+                pause=False, AND=AND, GIVEN=GIVEN):
+            # returns (value, spec, resume). with pause, it stops after a
+            # call which returned an awaitable and returns the index to
+            # resume from; the caller awaits the value and runs again.
+            ops = self._ops
+            if len(stack) != len(ops):
+                raise When.Plan.Mismatch()
+            trace = tracer.enabled
+            values = given._dict
+            value_class = Given.Value
+            if spec is None:
+                spec = []
+            for index in range(start, len(ops)):
+                term = stack[index]
+                (kind, name, call) = ops[index]
+                if term._name != name or term._callable != call:
+                    raise When.Plan.Mismatch()
+                if kind == AND:
+                    spec.append("and")
+                    continue
+                if trace:
+                    debug("term: %s, this: %s", name, _to_str(this))
+                    started = time.perf_counter()
+                if kind == GIVEN:
+                    # no current item, so get from given values
+                    try:
+                        this = values[name]
+                    except KeyError as err:
+                        raise AttributeError(err)
+                    if this.__class__ is Factory:
+                        this = given._resolve(name, this)
+                else:
+                    this = getattr(this, name)
+
+                # if term is not callable, process next term
+                if not call:
+                    spec.append(name)
+                    continue
+                # convert Given.Value arguments to their values
+                args = term._args
+                for x in args:
+                    if x.__class__ is value_class:
+                        args = [x.value if x.__class__ is value_class else x
+                                for x in args]
+                        break
+                kwargs = term._kwargs
+                for x in kwargs.values():
+                    if x.__class__ is value_class:
+                        kwargs = dict([(k, v.value if v.__class__ is value_class
+                                        else v) for (k, v) in kwargs.items()])
+                        break
+                # call and append
+                this = this(*args, **kwargs)
+                spec.append((_fmt_call, (name, args, kwargs)))
+                if trace:
+                    tracer.event("when.term", depth=2, term=name,
+                                 seconds=time.perf_counter() - started)
+                if pause and inspect.isawaitable(this):
+                    return (this, spec, index + 1)
+            return (this, spec, None)
+
+    def _get_spec(self):
+        return " ".join([_render_spec((t,)) for t in self._spec])
+
+    def _repeat(self):
+        # returns a function which runs the recorded chain once more, for
+        # matchers which measure it. the spec of the first run is kept.
+        plan = When.Plan(self._stack)
+        stack = list(self._stack)
+        given = self._fixture.given
+        def run():
+            return plan.run(stack, given)[0]
+        return run
 
     class Term():
+        __slots__ = ("_when", "_name", "_callable", "_args", "_kwargs")
+
         def __init__(self, when, name):
             self._when = when
             self._name = name
             self._callable = False
+            self._args = ()
+            self._kwargs = _NO_KWARGS
 
         def __getattr__(self, key):
             t = When.Term(self._when, key)
@@ -285,6 +2320,10 @@ class When():
             self._kwargs = kwargs
             return self
 
+        def __await__(self):
+            # `await when.client.fetch()` runs the chain on the event loop
+            return self._when._aeval().__await__()
+
         def __repr__(self):
             name = self._name
             if self._callable:
@@ -302,13 +2341,15 @@ class Then():
         self._spec = []
         self._current_spec = 0
 
-    def _get_spec(self):
-        when_spec = self._fixture.when._spec
-        return ("when %s, then %s" % (when_spec, "".join(self._spec))).strip()
+    def _get_spec(self, spec=None):
+        (when_spec, then_spec) = spec or (self._fixture.when._spec,
+                                          self._spec)
+        when_spec = " ".join([_render_spec((t,)) for t in when_spec])
+        return ("when %s, then %s" % (when_spec,
+                                      _render_spec(then_spec))).strip()
 
     def _get_current_spec(self):
-        spec = self._spec[self._current_spec:]
-        return "".join(spec).strip()
+        return _SpecText(self._spec, self._current_spec)
 
     def __getattr__(self, key):
         self._clear()
@@ -337,6 +2378,88 @@ class Then():
         return self._cursor
 
 
+def _element_difference(first, second, limit=5):
+    # (missing, extra): up to `limit` items of second which first lacks,
+    # and of first which second lacks, counting repeats. None if the two
+    # hold the same elements. sorting is tried first, then hashing.
+    if len(first) == len(second):
+        try:
+            if sorted(first) == sorted(second):
+                return None
+        except TypeError:
+            pass
+    try:
+        counts = collections.Counter(first)
+        counts.subtract(second)
+    except TypeError:
+        # unhashable items: the slow way
+        rest = list(first)
+        missing = []
+        for x in second:
+            try:
+                rest.remove(x)
+            except ValueError:
+                missing.append(x)
+        if not missing and not rest:
+            return None
+        return (missing[:limit], rest[:limit])
+    missing = list(itertools.islice(
+        (k for (k, v) in counts.items() if v < 0), limit))
+    extra = list(itertools.islice(
+        (k for (k, v) in counts.items() if v > 0), limit))
+    if not missing and not extra:
+        return None
+    return (missing, extra)
+
+def _first_unsorted(values, key=None, reverse=False):
+    # index of the first item which is out of order, or None
+    values = values if isinstance(values, list) else list(values)
+    if sorted(values, key=key, reverse=reverse) == values:
+        return None
+    keys = values if key is None else [key(x) for x in values]
+    for i in range(1, len(keys)):
+        if (keys[i] > keys[i - 1]) if reverse else (keys[i] < keys[i - 1]):
+            return i
+    return None
+
+def _first_duplicate(values):
+    # index of the first item which appeared before, or None
+    try:
+        if len(set(values)) == len(values):
+            return None
+        seen = set()
+        for (i, x) in enumerate(values):
+            if x in seen:
+                return i
+            seen.add(x)
+    except TypeError:
+        for (i, x) in enumerate(values):
+            if x in values[:i]:
+                return i
+    return None
+
+
+def _matcher(fn):
+    # emits a "matcher" trace event around an It matcher when tracing is on
+    name = fn.__name__.strip("_")
+
+    @functools.wraps(fn)
+    def matcher(self, *args, **kwargs):
+        if not tracer.enabled:
+            return fn(self, *args, **kwargs)
+        started = time.perf_counter()
+        passed = False
+        try:
+            result = fn(self, *args, **kwargs)
+            passed = True
+            return result
+        finally:
+            tracer.event("matcher", depth=2, matcher=name, passed=passed,
+                         seconds=time.perf_counter() - started,
+                         spec=str(self._get_spec()))
+    return matcher
+
+
 class It():
     CHAINS = set(["to", "be", "been", "is", "that", "which",
                   # "and" has special mean in spicy 
@@ -346,63 +2469,71 @@ class It():
                   "should", "value",
                   ])
 
+    __slots__ = ("_value", "_name", "_parent", "_exception", "_target",
+                 "_members")
+
     def __init__(self, value, name, parent):
         self._value = value
         self._name = name
         self._parent = parent
         self._exception = None
+        self._target = _NOTHING
+        self._members = None
 
     def _check_exception(self):
         if self._exception:
             raise self._exception
        
     def __getattr__(self, name):
-        if hasattr(self._value, name):
-            v = getattr(self._value, name)
-            self._parent._spec.append(".%s" % name)
+        v = getattr(self._value, name, _NOTHING)
+        if v is not _NOTHING:
+            self._parent._spec.append((_fmt_text, (".%s", name)))
             return It(v, name, self._parent)
         return self._chain_or_execute(name)
 
+    def __await__(self):
+        # `await then.client.fetch()` awaits the wrapped value. like a
+        # call, an exception is kept for _raise/not_raise to check.
+        value = self._value
+        if inspect.isawaitable(value):
+            try:
+                value = yield from value.__await__()
+            except Exception as e:
+                it = It(None, self._name, self._parent)
+                it._exception = e
+                return it
+        return It(value, self._name, self._parent)
+
     def _chain_or_execute(self, name):
         name = name.strip("_")
         if not name in self.CHAINS:
             self._check_exception()
             raise AttributeError(name)
-        self._parent._spec.append(" %s" % name)
+        self._parent._spec.append((_fmt_text, (" %s", name)))
         return self
 
     def __getitem__(self, name):
         self._check_exception()
         v = self._value[name]
-        self._parent._spec.append("{}[{}]".format(self._name, name))
+        self._parent._spec.append((_fmt_item, (self._name, name)))
         return It(v, name, self._parent)
 
     def __call__(self, *args, **kwargs):
         self._check_exception()
         if not callable(self._value):
             raise TypeError("%s is not callable" % self._value.__name__)
-        specs = []
 
         # convert GivenValue to the value
-        for arg in args:
-            if isinstance(arg, Given.Value):
-                specs.append("%s" % _to_str(arg.value))
-            else:
-                specs.append("%s" % _to_str(arg))
         args = [x.value if isinstance(x, Given.Value) else x for x in args]
-
         for k in kwargs.keys():
             if isinstance(kwargs[k], Given.Value):
-                specs.append("%s=%s" % (k, _to_str(kwargs[k].value)))
                 kwargs[k] = kwargs[k].value
-            else:
-                specs.append("%s=%s" % (k, _to_str(kwargs[k])))
-                kwargs[k] = kwargs[k]
 
-        debug("value: %s" % self._value)
-        debug("args: %s" % args)
-        debug("kwargs: %s" % kwargs)
-        name = "(%s)" % ", ".join(specs)
+        if tracer.enabled:
+            debug("value: %s", _to_str(self._value))
+            debug("args: %s", _to_str(args))
+            debug("kwargs: %s", _to_str(kwargs))
+        name = (_fmt_call, ("", args, kwargs))
         self._parent._spec.append(name)
 
         try:
@@ -419,8 +2550,7 @@ class It():
         self._check_exception()
         self._parent._spec.append(" and")
         self._parent._current_spec = len(self._parent._spec)
-        if hasattr(self, "_target"):
-            del self._target
+        self._target = _NOTHING
         self._parent._cursor = self
         return self._parent
 
@@ -433,58 +2563,64 @@ class It():
 
     def applied_to(self, value):
         self._check_exception()
-        if hasattr(self, "_target"):
-            target = self._target
-        else:
-            target = self._value
+        target = self._get_target()
         if isinstance(value, Given.Value):
             value = value.value
         self._parent._spec.append(" applied to")
-        self._parent._spec.append(" %s" % _to_str(value))
+        self._parent._spec.append((_fmt_value, (" %s", value)))
 
         self._target = value(target)
         return self
         
 
+    @_matcher
     def instance(self, the_type):
         self._check_exception()
-        self._parent._spec.append(" instance of %s" % the_type)
+        self._parent._spec.append((_fmt_text, (" instance of %s", the_type)))
         self._parent._fixture.assertIsInstance(self._value,
                                              the_type,
                                              self._get_spec())
         return self
 
+    @_matcher
     def property(self, value):
         self._check_exception()
         self._parent._spec.append(" property")
-        self._parent._spec.append(" %s" % _to_str(value))
-        self._parent._fixture.assertIn(value, self._value, self._get_spec())
+        self._parent._spec.append((_fmt_value, (" %s", value)))
+        if not self._contains(value, self._value):
+            self._fail("%s not found in %s" % (_to_str(value),
+                                               _to_str(self._value)))
         return self
 
+    @_matcher
     def length_of(self, value):
         self._check_exception()
         self._parent._spec.append(" length of")
-        self._parent._spec.append(" %s" % _to_str(value))
+        self._parent._spec.append((_fmt_value, (" %s", value)))
         self._parent._fixture.assertEqual(len(self._value),
                                           value, self._get_spec())
         return self
 
+    @_matcher
     def equal(self, value):
         self._check_exception()
-        if hasattr(self, "_target"):
-            target = self._target
-        else:
-            target = self._value
+        target = self._get_target()
         if isinstance(value, Given.Value):
             value = value.value
         self._parent._spec.append(" equal")
-        self._parent._spec.append(" %s" % _to_str(value))
-        
+        self._parent._spec.append((_fmt_value, (" %s", value)))
+
+        if _is_big(target) or _is_big(value):
+            # unittest would diff the full reprs of both
+            if not _equal(target, value):
+                self._fail(_fmt_difference(target, value))
+            return self
         self._parent._fixture.assertEqual(target, value, self._get_spec())
         return self
 
+    @_matcher
     def _raise(self, value):
-        self._parent._spec.append(" raises %s" % value.__name__)
+        self._parent._spec.append((_fmt_text, (" raises %s", value.__name__)))
         if not self._exception:
             msg = "%s not raised: %s" % (value, self._get_spec())
             raise self._parent._fixture.failureException(msg)
@@ -495,99 +2631,87 @@ class It():
         self._exception = None
         return self
 
+    @_matcher
     def not_raise(self, value):
-        self._parent._spec.append(" not raises %s" % value.__name__)
+        self._parent._spec.append((_fmt_text,
+                                   (" not raises %s", value.__name__)))
         if not self._exception:
             return self
         e = self._exception
         if isinstance(e, value):
-            msg = "%s raised : %s" % (value, e, self._get_spec())
+            msg = "%s raised: %s : %s" % (value, e, self._get_spec())
             raise self._parent._fixture.failureException(msg)
         self._exception = None
         return self
 
+    @_matcher
     def none(self):
         self._check_exception()
-        if hasattr(self, "_target"):
-            target = self._target
-        else:
-            target = self._value
+        target = self._get_target()
         self._parent._spec.append(" is None")
         self._parent._fixture.assertIsNone(target, self._get_spec())
         return self
 
+    @_matcher
     def true(self):
         self._check_exception()
-        if hasattr(self, "_target"):
-            target = self._target
-        else:
-            target = self._value
+        target = self._get_target()
         self._parent._spec.append(" is True")
         self._parent._fixture.assertTrue(target, self._get_spec())
         return self
 
+    @_matcher
     def false(self):
         self._check_exception()
-        if hasattr(self, "_target"):
-            target = self._target
-        else:
-            target = self._value
+        target = self._get_target()
         self._parent._spec.append(" is False")
         self._parent._fixture.assertFalse(target, self._get_spec())
         return self
 
+    @_matcher
     def greater_equal(self, value):
         self._check_exception()
-        if hasattr(self, "_target"):
-            target = self._target
-        else:
-            target = self._value
+        target = self._get_target()
         if isinstance(value, Given.Value):
             value = value.value
         self._parent._spec.append(" greater equal")
-        self._parent._spec.append(" %s" % _to_str(value))
+        self._parent._spec.append((_fmt_value, (" %s", value)))
         
         self._parent._fixture.assertGreaterEqual(target, value, self._get_spec())
         return self
 
+    @_matcher
     def less_equal(self, value):
         self._check_exception()
-        if hasattr(self, "_target"):
-            target = self._target
-        else:
-            target = self._value
+        target = self._get_target()
         if isinstance(value, Given.Value):
             value = value.value
         self._parent._spec.append(" less equal")
-        self._parent._spec.append(" %s" % _to_str(value))
+        self._parent._spec.append((_fmt_value, (" %s", value)))
         
         self._parent._fixture.assertLessEqual(target, value, self._get_spec())
         return self
 
+    @_matcher
     def greater_than(self, value):
         self._check_exception()
-        if hasattr(self, "_target"):
-            target = self._target
-        else:
-            target = self._value
+        target = self._get_target()
         if isinstance(value, Given.Value):
             value = value.value
         self._parent._spec.append(" greater than")
-        self._parent._spec.append(" %s" % _to_str(value))
+        self._parent._spec.append((_fmt_value, (" %s", value)))
         
         self._parent._fixture.assertGreater(target, value, self._get_spec())
         return self
 
+    @_matcher
     def less_than(self, value):
         self._check_exception()
-        if hasattr(self, "_target"):
-            target = self._target
-        else:
-            target = self._value
+        target = self._get_target()
         if isinstance(value, Given.Value):
             value = value.value
         self._parent._spec.append(" less than")
-        self._parent._spec.append(" %s" % _to_str(value))
+        self._parent._spec.append((_fmt_value, (" %s", value)))
         
         self._parent._fixture.assertLess(target, value, self._get_spec())
         return self
@@ -595,14 +2719,348 @@ class It():
     def at(self, value):
         self._check_exception()
         self._parent._spec.append(" at")
-        self._parent._spec.append(" %s" % _to_str(value))
+        self._parent._spec.append((_fmt_value, (" %s", value)))
         self._target = self._value[value]
         return self
 
+    # performance matchers. they run the recorded 'when' chain again,
+    # after some warm-up runs, and judge on the distribution of samples.
+
+    @_matcher
+    def complete_within(self, ms=None, us=None, s=None, percentile=50,
+                        samples=30, warmup=3):
+        self._check_exception()
+        limit = _to_seconds(ms=ms, us=us, s=s)
+        self._parent._spec.append((_fmt_text, (" complete within %s",
+                                               _fmt_seconds(limit))))
+        run = self._parent._fixture.when._repeat()
+        clock = time.perf_counter
+        for i in range(warmup):
+            run()
+        times = []
+        for i in range(samples):
+            started = clock()
+            run()
+            times.append(clock() - started)
+        times.sort()
+        measured = _percentile(times, percentile)
+        if measured > limit:
+            msg = "p%s %s > %s (p90 %s, n=%d) : %s" % (
+                percentile, _fmt_seconds(measured), _fmt_seconds(limit),
+                _fmt_seconds(_percentile(times, 90)), samples,
+                self._get_spec())
+            raise self._parent._fixture.failureException(msg)
+        return self
+
+    @_matcher
+    def allocate_at_most(self, kb=None, b=None, mb=None, samples=5,
+                         warmup=1):
+        self._check_exception()
+        limit = _to_bytes(b=b, kb=kb, mb=mb)
+        self._parent._spec.append((_fmt_text, (" allocate at most %s",
+                                               _fmt_bytes(limit))))
+        run = self._parent._fixture.when._repeat()
+        for i in range(warmup):
+            run()
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        peaks = []
+        try:
+            for i in range(samples):
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                run()
+                peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        peaks.sort()
+        measured = _percentile(peaks, 50)
+        if measured > limit:
+            msg = "median peak %s > %s (max %s, n=%d) : %s" % (
+                _fmt_bytes(measured), _fmt_bytes(limit),
+                _fmt_bytes(peaks[-1]), samples, self._get_spec())
+            raise self._parent._fixture.failureException(msg)
+        return self
+
+    allocates_at_most = allocate_at_most
+
+    @_matcher
+    def sustain(self, ops_per_sec, seconds=0.2, batches=5, warmup=3):
+        self._check_exception()
+        self._parent._spec.append((_fmt_text, (" sustain %s ops/sec",
+                                               ops_per_sec)))
+        run = self._parent._fixture.when._repeat()
+        clock = time.perf_counter
+        for i in range(warmup):
+            run()
+        # every batch runs for about seconds / batches
+        budget = seconds / batches
+        rates = []
+        for i in range(batches):
+            calls = 0
+            started = clock()
+            elapsed = 0.0
+            while elapsed < budget:
+                run()
+                calls += 1
+                elapsed = clock() - started
+            rates.append(calls / elapsed)
+        rates.sort()
+        measured = _percentile(rates, 50)
+        if measured < ops_per_sec:
+            msg = "median %.1f ops/sec < %s (min %.1f, n=%d) : %s" % (
+                measured, ops_per_sec, rates[0], batches, self._get_spec())
+            raise self._parent._fixture.failureException(msg)
+        return self
+
+    throughput_at_least = sustain
+
+    @_matcher
+    def match_snapshot(self, name=None):
+        # compares with the value stored under name, by default the id of
+        # the scenario and the number of this snapshot in it. a missing
+        # snapshot is stored; the stored payload is only read on mismatch.
+        import spicy_snapshot
+        self._check_exception()
+        target = self._get_target()
+        fixture = self._parent._fixture
+        fixture._snapshots += 1
+        if name is None:
+            name = "%s %d" % (_snapshot_owner(fixture), fixture._snapshots)
+        self._parent._spec.append((_fmt_text, (" match snapshot %s", name)))
+        path = os.environ.get("SPICY_SNAPSHOT_STORE") \
+            or getattr(fixture, "snapshot_store", BddTest.snapshot_store)
+        store = spicy_snapshot.SnapshotStore.open(path)
+        update = bool(os.environ.get("SPICY_SNAPSHOT_UPDATE"))
+        entry = store.check(name, target, update)
+        if entry is None:
+            return self
+        (kind, payload) = spicy_snapshot.encode(target)
+        stored = store.payload(entry)
+        if kind != entry.kind:
+            self._fail("%s does not match the stored %s"
+                       % (_to_str(target), _to_str(
+                           spicy_snapshot.decode(entry.kind, stored))))
+        if kind == b"b":
+            index = _first_difference(payload, stored)
+            self._fail("bytes differ at %d (lengths %d and %d)\n"
+                       "  got: %s\n  stored: %s"
+                       % (index, len(payload), len(stored),
+                          _to_str(bytes(payload[index:index + 16])),
+                          _to_str(bytes(stored[index:index + 16]))))
+        if kind == b"s":
+            self._fail(_fmt_difference(target.splitlines(),
+                                       str(stored, "utf-8").splitlines()))
+        self._fail(_fmt_difference(spicy_snapshot.decode(kind, payload),
+                                   spicy_snapshot.decode(kind, stored)))
+
+    @_matcher
+    def not_leak(self, runs=10, warmup=2, kb=None, b=None, mb=None):
+        # the chain must not keep more memory or live objects after every
+        # run. kb, b or mb is the growth per run which is let go.
+        self._check_exception()
+        limit = 0
+        if (kb, b, mb) != (None, None, None):
+            limit = _to_bytes(b=b, kb=kb, mb=mb)
+        self._parent._spec.append(" not leak")
+        run = self._parent._fixture.when._repeat()
+        growth = _check_growth(run, runs, warmup, limit)
+        if growth:
+            self._fail(growth)
+        return self
+
+    @_matcher
+    def contain_all(self, *values):
+        self._check_exception()
+        values = [x.value if isinstance(x, Given.Value) else x
+                  for x in values]
+        self._parent._spec.append(" contain all of")
+        self._parent._spec.append((_fmt_value, (" %s", values)))
+        target = self._get_target()
+        missing = [x for x in values if not self._contains(x, target)]
+        if missing:
+            self._fail("%d of %d missing: %s" % (len(missing), len(values),
+                                                 _to_str(missing[:5])))
+        return self
+
+    contains_all = contain_all
+
+    @_matcher
+    def same_elements_as(self, value):
+        self._check_exception()
+        target = self._get_target()
+        if isinstance(value, Given.Value):
+            value = value.value
+        self._parent._spec.append(" same elements as")
+        self._parent._spec.append((_fmt_value, (" %s", value)))
+        if _equal(target, value):
+            return self
+        difference = _element_difference(target, value)
+        if difference:
+            self._fail("missing %s, unexpected %s" % (
+                _to_str(difference[0]), _to_str(difference[1])))
+        return self
+
+    @_matcher
+    def sorted(self, key=None, reverse=False):
+        self._check_exception()
+        target = self._get_target()
+        self._parent._spec.append(" sorted")
+        index = _first_unsorted(target, key, reverse)
+        if index is not None:
+            self._fail("%s before %s at index %d" % (
+                _to_str(target[index - 1]), _to_str(target[index]), index))
+        return self
+
+    @_matcher
+    def no_duplicates(self):
+        self._check_exception()
+        target = self._get_target()
+        self._parent._spec.append(" no duplicates")
+        index = _first_duplicate(target)
+        if index is not None:
+            self._fail("%s repeated at index %d" % (_to_str(target[index]),
+                                                    index))
+        return self
+
+    def _contains(self, value, target):
+        # `in`, through a set of the items for big sequences. the set is
+        # built once, so chained membership checks stay linear in total.
+        if not isinstance(target, (list, tuple, collections.deque)) \
+           or len(target) < 64:
+            return value in target
+        members = self._members
+        if members is None or members[0] is not target:
+            try:
+                members = (target, frozenset(target))
+            except TypeError:
+                members = (target, None)
+            self._members = members
+        if members[1] is None:
+            return value in target
+        try:
+            return value in members[1]
+        except TypeError:
+            return value in target
+
+    def _fail(self, message):
+        fixture = self._parent._fixture
+        fixture.fail(fixture._formatMessage(self._get_spec(), message))
+
+    def _get_target(self):
+        if self._target is _NOTHING:
+            return self._value
+        return self._target
+
     def _get_spec(self):
         return self._parent._get_current_spec()
 
     class InvalidGrammar(Exception):
         pass
-                            
 
+
+class BddTestProgram(unittest.TestProgram):
+    # unittest.main with spicy specific options:
+    #   --slowest N    print the N slowest scenarios after the run
+    #   --timings FILE export per-scenario timings as JSON
+    #   --junit-xml FILE, --report-jsonl FILE
+    #                  stream the outcome of every scenario to FILE
+    #   --shard K/N    run the K-th of N parts of the suite, balanced by
+    #                  the durations in --shard-timings FILE if given
+    #   --impact       only run the scenarios affected by changed files,
+    #                  as recorded in --impact-index FILE
+    #   --leak-check N run every passing scenario N times more, failing
+    #                  the ones whose memory or live objects keep growing
+    #   --snapshot-update
+    #                  store the values match_snapshot finds different
+    #   --profile MODE profile every scenario with cprofile or sample,
+    #                  writing the added up profiles to --profile-dir DIR
+    def _getParentArgParser(self):
+        parser = super()._getParentArgParser()
+        parser.add_argument('--slowest', type=int, metavar='N',
+                            help='Show the N slowest scenarios')
+        parser.add_argument('--timings', metavar='FILE',
+                            help='Write per-scenario timings to FILE')
+        parser.add_argument('--junit-xml', metavar='FILE',
+                            help='Write scenario outcomes as JUnit XML')
+        parser.add_argument('--report-jsonl', metavar='FILE',
+                            help='Write scenario outcomes as JSON lines')
+        parser.add_argument('--shard', metavar='K/N',
+                            help='Only run the K-th of N shards')
+        parser.add_argument('--shard-timings', metavar='FILE',
+                            help='Balance shards by the timings in FILE')
+        parser.add_argument('--impact', action='store_true',
+                            help='Only run scenarios affected by changes')
+        parser.add_argument('--impact-index', metavar='FILE',
+                            default='.spicy/impact.json',
+                            help='Index of the files each scenario runs')
+        parser.add_argument('--leak-check', type=int, metavar='N',
+                            help='Rerun scenarios N times to find leaks')
+        parser.add_argument('--snapshot-update', action='store_true',
+                            help='Store snapshots which differ')
+        parser.add_argument('--profile', choices=('cprofile', 'sample'),
+                            help='Profile every scenario')
+        parser.add_argument('--profile-dir', metavar='DIR',
+                            default='.spicy/profile',
+                            help='Where the profiles are written')
+        return parser
+
+    def runTests(self):
+        global sharding, impact, profiler
+        if getattr(self, "shard", None):
+            sharding = Sharding.parse(self.shard, self.shard_timings)
+        if getattr(self, "impact", False) and impact is None:
+            impact = ImpactIndex(self.impact_index)
+            atexit.register(impact.save)
+
+        if getattr(self, "leak_check", None):
+            # through the environment, so that worker processes see it
+            os.environ["SPICY_LEAK_CHECK"] = str(self.leak_check)
+        if getattr(self, "snapshot_update", False):
+            os.environ["SPICY_SNAPSHOT_UPDATE"] = "1"
+        if getattr(self, "profile", None) and profiler is None:
+            # also through the environment, for spawned worker processes
+            os.environ["SPICY_PROFILE"] = self.profile
+            os.environ["SPICY_PROFILE_DIR"] = self.profile_dir
+            import spicy_profile
+            profiler = spicy_profile.SuiteProfile.from_env()
+            atexit.register(profiler.save)
+
+        configured = []
+        if getattr(self, "slowest", None):
+            BddTestResult.slowest_kept = max(BddTestResult.slowest_kept,
+                                             self.slowest)
+        if getattr(self, "timings", None):
+            configured.append(TimingsReporter(self.timings))
+        if getattr(self, "junit_xml", None):
+            configured.append(JUnitXmlReporter(self.junit_xml))
+        if getattr(self, "report_jsonl", None):
+            configured.append(JsonlReporter(self.report_jsonl))
+        if configured:
+            reporters.configure(configured)
+
+        exit = self.exit
+        self.exit = False
+        try:
+            super().runTests()
+        finally:
+            if configured:
+                reporters.configure()
+        self.exit = exit
+
+        timings = getattr(self.result, "scenario_timings", None) or []
+        if getattr(self, "slowest", None):
+            print_slowest(timings, self.slowest)
+        if self.exit:
+            sys.exit(not self.result.wasSuccessful())
+
+main = BddTestProgram
+
+
+if __name__ == '__main__':
+    # run through the imported module, so that test modules share its
+    # classes with this runner
+    import spicy_bdd
+    spicy_bdd.main(module=None)
@@ -0,0 +1,409 @@
+import unittest
+import os
+import sys
+import json
+import time
+import fnmatch
+import argparse
+import platform
+import tracemalloc
+import gc
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import spicy_bdd
+from spicy_bdd import (BddTest, TestCaseFixture, ScenarioFailure)
+
+# micro benchmarks for the given/when/then pipeline.
+#
+# a benchmark whose callable returns what it built, as the then chains
+# do, also reports the memory blocks and bytes one call leaves alive
+# through its result, the cost of the DSL nodes themselves.
+#
+#   python spicy_bench.py                      run every benchmark
+#   python spicy_bench.py -k 'when_*'          run the matching ones
+#   python spicy_bench.py --save base.json     store the results
+#   python spicy_bench.py --compare base.json  fail on regressions
+
+BENCHMARKS = []
+
+def benchmark(name, ops=1):
+    # registers a factory which returns the callable to measure. ops is
+    # the number of scenarios (or other units) one call stands for.
+    def register(factory):
+        BENCHMARKS.append((name, factory, ops))
+        return factory
+    return register
+
+
+class _Case(unittest.TestCase):
+    def runTest(self):
+        pass
+
+
+def _fixture():
+    return TestCaseFixture(_Case())
+
+def _add(x, y):
+    return x + y
+
+def _identity(x):
+    return x
+
+
+@benchmark("given")
+def bench_given():
+    f = _fixture()
+    given = f.given
+    def run():
+        given(a=1, b=2, c=3, add=_add)
+    return run
+
+
+def _when_chain(length):
+    f = _fixture()
+    given, when = f.given, f.when
+    given(f=_identity, a=1)
+    def run():
+        t = when.f(given.a)
+        for i in range(length - 1):
+            t = t._and.f(given.a)
+        when._eval()
+        return t
+    return run
+
+for _length in (1, 4, 16):
+    benchmark("when_chain_%d" % _length)(
+        lambda length=_length: _when_chain(length))
+
+
+def _then_chain(length):
+    f = _fixture()
+    given, when, then = f.given, f.when, f.then
+    given(the_list=[1, 2, 3])
+    when.the_list.append(4)
+    def run():
+        t = then.the_list.length.should.equal(4)
+        for i in range(length - 1):
+            t = t._and.the.value.at(0).should.equal(1)
+        return t
+    return run
+
+for _length in (1, 4, 16):
+    benchmark("then_chain_%d" % _length)(
+        lambda length=_length: _then_chain(length))
+
+
+@benchmark("then_nodes")
+def bench_then_nodes():
+    # every node of a then chain, kept as a scenario holding its clauses
+    # would keep them, so that their allocations are counted
+    f = _fixture()
+    given, when, then = f.given, f.when, f.then
+    given(the_list=[1, 2, 3])
+    when.the_list.append(4)
+    def run():
+        nodes = [then]
+        for name in ("the_list", "length", "should"):
+            nodes.append(getattr(nodes[-1], name))
+        nodes.append(nodes[-1].equal(4))
+        for name in ("_and", "the", "value"):
+            nodes.append(getattr(nodes[-1], name))
+        nodes.append(nodes[-1].at(0))
+        nodes.append(nodes[-1].should)
+        nodes.append(nodes[-1].equal(1))
+        return nodes
+    return run
+
+
+@benchmark("failure_render")
+def bench_failure_render():
+    f = _fixture()
+    given, when, then = f.given, f.when, f.then
+    given(add=_add, a=1, b=2)
+    when.add(given.a, given.b)
+    try:
+        then.it.should.equal(4)
+    except AssertionError as e:
+        err = ScenarioFailure(e, f)
+    def run():
+        str(err)
+    return run
+
+
+def _synthetic_suite(n):
+    def scenario(self, given, when, then):
+        given(add=_add, a=1, b=2)
+        when.add(given.a, given.b)
+        then.it.should.equal(3)
+    attrs = dict([("scenario_synthetic_%05d" % i, scenario)
+                  for i in range(n)])
+    attrs["workers"] = 1
+    cls = type("SyntheticTest%d" % n, (BddTest,), attrs)
+    def run():
+        cls().run(unittest.TestResult())
+    return run
+
+for _n in (10, 1000):
+    benchmark("suite_run_%d" % _n, ops=_n)(
+        lambda n=_n: _synthetic_suite(n))
+
+
+def _traced_blocks():
+    # (blocks, bytes) traced by tracemalloc, without the snapshot
+    stats = tracemalloc.take_snapshot().statistics("filename")
+    return (sum([x.count for x in stats]), sum([x.size for x in stats]))
+
+def measure(fn, min_time=0.05, repeat=5, kept=100):
+    # calibrates the loop count so that one sample takes at least
+    # min_time, then keeps the best of `repeat` samples. returns the
+    # seconds per call, the peak memory of a call and, when fn returns
+    # something, the blocks and bytes a call allocated which its result
+    # keeps alive, from `kept` results held at once.
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for i in range(loops):
+            fn()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    samples = [elapsed]
+    for i in range(repeat - 1):
+        started = time.perf_counter()
+        for j in range(loops):
+            fn()
+        samples.append(time.perf_counter() - started)
+    best = min(samples) / loops
+
+    # peak memory of a single call, measured apart from the timing
+    tracemalloc.start()
+    try:
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        allocations = allocated = 0
+        if result is not None:
+            del result
+            # the list holding the results is there before counting
+            results = [None] * kept
+            gc.collect()
+            (blocks, size) = _traced_blocks()
+            for i in range(kept):
+                results[i] = fn()
+            gc.collect()
+            (blocks_after, size_after) = _traced_blocks()
+            del results
+            # rounded, as the interpreter may allocate a block of its own
+            # now and then
+            allocations = round((blocks_after - blocks) / kept, 1)
+            allocated = round((size_after - size) / kept)
+    finally:
+        tracemalloc.stop()
+    return (best, peak, allocations, allocated)
+
+
+def calibrate(fn, min_time=0.01, max_loops=1 << 24):
+    # smallest power of two loop count whose run takes min_time
+    loops = 1
+    while loops < max_loops:
+        started = time.perf_counter()
+        for i in range(loops):
+            fn()
+        if time.perf_counter() - started >= min_time:
+            break
+        loops *= 2
+    return loops
+
+
+def reject_outliers(values):
+    # drops samples outside of 1.5 IQR from the quartiles. values must be
+    # sorted; too few samples are returned as they are.
+    if len(values) < 4:
+        return values
+    q1 = spicy_bdd._percentile(values, 25)
+    q3 = spicy_bdd._percentile(values, 75)
+    low = q1 - (q3 - q1) * 1.5
+    high = q3 + (q3 - q1) * 1.5
+    return [x for x in values if low <= x <= high]
+
+
+def run_calibrated(fn, min_time=0.01, samples=15, warmup=2):
+    # measures seconds per call of fn, as used by bench_ scenarios
+    loops = calibrate(fn, min_time)
+    for i in range(warmup):
+        for j in range(loops):
+            fn()
+    times = []
+    for i in range(samples):
+        started = time.perf_counter()
+        for j in range(loops):
+            fn()
+        times.append((time.perf_counter() - started) / loops)
+    times.sort()
+    kept = reject_outliers(times)
+    return {"median": spicy_bdd._percentile(kept, 50),
+            "iqr": (spicy_bdd._percentile(kept, 75)
+                    - spicy_bdd._percentile(kept, 25)),
+            "min": kept[0],
+            "loops": loops,
+            "samples": len(kept),
+            "outliers": len(times) - len(kept)}
+
+
+class BaselineStore():
+    # medians of bench_ scenarios, by scenario id, in one json file.
+    # every put() merges its median into what the file holds by then,
+    # under a lock, and replaces the file atomically, so that worker
+    # processes don't drop each other's medians.
+    _stores = {}
+
+    @classmethod
+    def open(cls, path):
+        path = os.path.abspath(path)
+        store = cls._stores.get(path)
+        if store is None:
+            store = cls._stores[path] = cls(path)
+        return store
+
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path) as f:
+                    self._data = json.load(f)
+            except FileNotFoundError:
+                self._data = {}
+        return self._data
+
+    def get(self, name):
+        stats = self._load().get(name)
+        if stats is None:
+            # another process may have stored it since the file was read
+            self._data = None
+            stats = self._load().get(name)
+        return stats
+
+    def put(self, name, stats):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # the file itself is replaced, so the lock is on a file beside it
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            self._data = None
+            self._load()[name] = stats
+            tmp = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(self._data, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        finally:
+            os.close(fd)
+
+
+def run_benchmarks(pattern=None, min_time=0.05, repeat=5):
+    results = {}
+    for (name, factory, ops) in BENCHMARKS:
+        if pattern and not fnmatch.fnmatch(name, pattern):
+            continue
+        (seconds, peak, allocations, allocated) = measure(
+            factory(), min_time, repeat)
+        results[name] = {"seconds": seconds,
+                         "ops_per_sec": ops / seconds,
+                         "per_op_us": seconds / ops * 1e6,
+                         "peak_bytes": peak,
+                         "allocations": allocations,
+                         "allocated_bytes": allocated}
+    return results
+
+
+def compare(results, baseline, threshold):
+    # returns [(name, field, old, new)] for every result which got worse
+    # than the baseline by more than threshold (a ratio, 0.1 is 10%)
+    regressions = []
+    for (name, result) in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        if result["ops_per_sec"] < old["ops_per_sec"] * (1 - threshold):
+            regressions.append((name, "ops_per_sec",
+                                old["ops_per_sec"], result["ops_per_sec"]))
+        for field in ("peak_bytes", "allocations", "allocated_bytes"):
+            # baselines saved before a field was measured don't have it
+            if field in old and field in result \
+               and result[field] > old[field] * (1 + threshold):
+                regressions.append((name, field, old[field], result[field]))
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)["benchmarks"]
+
+def save_baseline(path, results):
+    data = {"python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "benchmarks": results}
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def report(results, baseline=None, stream=None):
+    stream = stream or sys.stdout
+    print("%-18s %14s %14s %12s %8s %10s %10s" % (
+        "benchmark", "ops/sec", "per op (us)", "peak (B)", "allocs",
+        "alloc (B)", "change"), file=stream)
+    for (name, r) in results.items():
+        change = ""
+        if baseline and name in baseline:
+            old = baseline[name]["ops_per_sec"]
+            change = "%+.1f%%" % ((r["ops_per_sec"] / old - 1) * 100)
+        print("%-18s %14.1f %14.2f %12d %8.1f %10.1f %10s" % (
+            name, r["ops_per_sec"], r["per_op_us"], r["peak_bytes"],
+            r["allocations"], r["allocated_bytes"], change), file=stream)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="micro benchmarks for spicy_bdd")
+    parser.add_argument("-k", dest="pattern",
+                        help="only run benchmarks matching this glob")
+    parser.add_argument("--min-time", type=float, default=0.05,
+                        help="minimum seconds per sample")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of samples per benchmark")
+    parser.add_argument("--save", metavar="FILE",
+                        help="write the results as a baseline file")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare against a baseline file")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="allowed slowdown ratio before failing")
+    args = parser.parse_args(argv)
+
+    # tracing would measure the tracer, not the framework
+    spicy_bdd.tracer.configure(None)
+    results = run_benchmarks(args.pattern, args.min_time, args.repeat)
+    baseline = load_baseline(args.compare) if args.compare else None
+    report(results, baseline)
+    if args.save:
+        save_baseline(args.save, results)
+    if baseline is None:
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for (name, field, old, new) in regressions:
+        print("REGRESSION: %s %s %.1f -> %.1f" % (name, field, old, new),
+              file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,422 @@
+import os
+import re
+import pickle
+import hashlib
+
+from spicy_bdd import BddTest
+
+# runs gherkin .feature files as spicy scenarios.
+#
+#   # steps.py
+#   from spicy_gherkin import given_step, when_step, then_step
+#
+#   @when_step("I add {a:d} and {b:d}")
+#   def add(given, when, then, a, b):
+#       when.calculator.add(a, b)
+#
+#   # test_features.py
+#   import steps
+#   globals().update(spicy_gherkin.load_features("features", __name__))
+#
+# every feature becomes a BddTest class, and every scenario (or row of
+# a scenario outline) one of its scenario_ methods, which calls the
+# step functions matching its steps with given, when and then.
+#
+# parsing and binding are cached in one file, .spicy/gherkin.cache by
+# default: the regexes of the step patterns, by a hash of the patterns,
+# and every feature parsed, by its mtime and size or else the hash of
+# its content, with the step functions its steps bound to. a warm start
+# stats the files and loads the cache, without parsing or regexes.
+
+CACHE_VERSION = 2
+
+_placeholder = re.compile(r"\{(\w+)(?::([dfw]))?\}")
+_types = {None: (r".+?", None), "d": (r"-?\d+", int),
+          "f": (r"-?\d+(?:\.\d+)?", float), "w": (r"\w+", None)}
+
+KEYWORDS = {"Given": "given", "When": "when", "Then": "then",
+            "And": None, "But": None, "*": None}
+
+
+class UndefinedStep(LookupError):
+    pass
+
+
+class StepRegistry():
+    # (kind, pattern, function) of every step definition, in the order
+    # they were defined, which is also the order they are tried in
+    def __init__(self):
+        self.steps = []
+
+    def add(self, kind, pattern, fn):
+        self.steps.append((kind, pattern, fn))
+
+    def fingerprint(self):
+        text = "\n".join(["%s %s" % (kind, pattern)
+                          for (kind, pattern, fn) in self.steps])
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def index(self, cached=None):
+        # (kind, literal prefix, regex source, converters) per step, from
+        # the cache when it was built for the same patterns
+        fingerprint = self.fingerprint()
+        if cached is not None and cached[0] == fingerprint:
+            return cached
+        entries = []
+        for (kind, pattern, fn) in self.steps:
+            (source, converters) = _translate(pattern)
+            prefix = _placeholder.split(pattern, 1)[0]
+            entries.append((kind, prefix, source, converters))
+        return (fingerprint, entries)
+
+    def binder(self, index):
+        return _Binder(index[1])
+
+
+def _translate(pattern):
+    # a pattern like "I add {a:d} and {b}" as a regex source, and the
+    # converters of its typed placeholders
+    parts = []
+    converters = {}
+    end = 0
+    for m in _placeholder.finditer(pattern):
+        (expression, converter) = _types[m.group(2)]
+        parts.append(re.escape(pattern[end:m.start()]))
+        parts.append("(?P<%s>%s)" % (m.group(1), expression))
+        if converter is not None:
+            converters[m.group(1)] = converter
+        end = m.end()
+    parts.append(re.escape(pattern[end:]))
+    return ("".join(parts), converters)
+
+
+class _Binder():
+    # finds the step definition of a step. only the patterns whose
+    # literal prefix the step starts with are matched, bucketed by their
+    # first word, and steps repeated across features are bound once.
+    # regexes are compiled on first use.
+    def __init__(self, entries):
+        self._entries = entries
+        self._compiled = {}
+        self._buckets = {}
+        self._bound = {}
+        for (position, (kind, prefix, source, converters)) \
+                in enumerate(entries):
+            first = prefix.split(" ", 1)[0] if " " in prefix else ""
+            self._buckets.setdefault(first, []).append(position)
+
+    def bind(self, kind, text):
+        # (position, params) of the first matching definition, or None
+        key = (kind, text)
+        if key not in self._bound:
+            self._bound[key] = self._bind(kind, text)
+        return self._bound[key]
+
+    def _bind(self, kind, text):
+        first = text.split(" ", 1)[0]
+        candidates = self._buckets.get(first, []) \
+            + self._buckets.get("", [])
+        for position in sorted(candidates):
+            (step_kind, prefix, source, converters) = self._entries[position]
+            if step_kind != "step" and step_kind != kind \
+               or not text.startswith(prefix):
+                continue
+            regex = self._compiled.get(position)
+            if regex is None:
+                regex = self._compiled[position] = re.compile(source)
+            m = regex.fullmatch(text)
+            if m is None:
+                continue
+            params = m.groupdict()
+            for (name, converter) in converters.items():
+                params[name] = converter(params[name])
+            return (position, params)
+        return None
+
+
+steps = StepRegistry()
+
+def _register(kind):
+    def decorator(pattern):
+        def register(fn):
+            steps.add(kind, pattern, fn)
+            return fn
+        return register
+    return decorator
+
+given_step = _register("given")
+when_step = _register("when")
+then_step = _register("then")
+# a step of any kind
+step = _register("step")
+
+
+def parse(text, path="<feature>"):
+    # {"name", "scenarios": [(name, [(kind, text, line, extra)])]} of a
+    # feature. extra is {"table": rows} or {"text": doc string} or {}.
+    # background steps are copied into every scenario, and an outline
+    # is expanded into one scenario per row of its examples.
+    feature = {"name": None, "scenarios": []}
+    background = []
+    current = None
+    outline = None
+    kind = None
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        i += 1
+        if not line or line.startswith("#") or line.startswith("@"):
+            continue
+        (keyword, sep, rest) = line.partition(":")
+        keyword = keyword.strip()
+        if sep and keyword == "Feature":
+            feature["name"] = rest.strip()
+            current = None
+        elif sep and keyword == "Rule":
+            current = None
+        elif sep and keyword == "Background":
+            current = background
+            kind = None
+        elif sep and keyword in ("Scenario", "Example"):
+            current = list(background)
+            feature["scenarios"].append((rest.strip(), current))
+            outline = None
+            kind = None
+        elif sep and keyword in ("Scenario Outline", "Scenario Template"):
+            current = list(background)
+            outline = (rest.strip(), current)
+            kind = None
+        elif sep and keyword in ("Examples", "Scenarios"):
+            if outline is None:
+                raise SyntaxError("%s:%d: examples without an outline"
+                                  % (path, i))
+            (rows, i) = _table(lines, i)
+            for (n, row) in enumerate(_rows(rows)):
+                feature["scenarios"].append((
+                    "%s example %d" % (outline[0], n + 1),
+                    [_substitute(x, row) for x in outline[1]]))
+            current = None
+        elif line.startswith('"""') or line.startswith("```"):
+            if not current:
+                raise SyntaxError("%s:%d: doc string without a step"
+                                  % (path, i))
+            (doc, i) = _doc_string(lines, i, line[:3])
+            current[-1][3]["text"] = doc
+        elif line.startswith("|"):
+            if not current:
+                raise SyntaxError("%s:%d: table without a step" % (path, i))
+            (rows, i) = _table(lines, i - 1)
+            current[-1][3]["table"] = _rows(rows)
+        else:
+            (word, space, rest) = line.partition(" ")
+            if word not in KEYWORDS or current is None:
+                # the description of a feature or scenario
+                continue
+            kind = KEYWORDS[word] or kind or "given"
+            current.append((kind, rest.strip(), i, {}))
+    return feature
+
+def _table(lines, i):
+    while i < len(lines) and not lines[i].strip():
+        i += 1
+    rows = []
+    while i < len(lines) and lines[i].strip().startswith("|"):
+        rows.append([x.strip() for x in lines[i].strip()[1:-1].split("|")])
+        i += 1
+    return (rows, i)
+
+def _rows(rows):
+    # the rows of a table, as dicts by the names in its first row
+    return [dict(zip(rows[0], x)) for x in rows[1:]]
+
+def _doc_string(lines, i, fence):
+    start = i
+    indent = len(lines[i - 1]) - len(lines[i - 1].lstrip())
+    while i < len(lines) and lines[i].strip() != fence:
+        i += 1
+    doc = "\n".join([x[indent:] for x in lines[start:i]])
+    return (doc, i + 1)
+
+def _substitute(step, row):
+    (kind, text, line, extra) = step
+    for (name, value) in row.items():
+        text = text.replace("<%s>" % name, value)
+    return (kind, text, line, extra)
+
+
+class FeatureCache():
+    # parsed and bound features by path, kept in one pickle. entries are
+    # (mtime_ns, size, sha1, fingerprint, method names, steps), where
+    # steps is the pickle of the steps and bindings of every scenario,
+    # only unpickled when one of them runs.
+    def __init__(self, path):
+        self.path = path
+        self.dirty = False
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            data = None
+        if not data or data.get("version") != CACHE_VERSION:
+            data = {"version": CACHE_VERSION, "index": None,
+                    "features": {}}
+        self.data = data
+
+    def index(self, registry):
+        index = registry.index(self.data["index"])
+        if index is not self.data["index"]:
+            self.data["index"] = index
+            self.dirty = True
+        return index
+
+    def feature(self, path, index, binder):
+        # (title, method names, steps), parsing and binding only what
+        # changed since the entry was made
+        stat = os.stat(path)
+        entry = self.data["features"].get(path)
+        if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+            with open(path, "rb") as f:
+                content = f.read()
+            digest = hashlib.sha1(content).hexdigest()
+            if entry is None or entry[2] != digest:
+                entry = (None, None, digest, None, parse(
+                    content.decode("utf-8"), path), None)
+            entry = (stat.st_mtime_ns, stat.st_size) + entry[2:]
+            self.dirty = True
+        if entry[3] != index[0]:
+            feature = entry[4]
+            if isinstance(feature, tuple):
+                feature = pickle.loads(entry[5])[0]
+            bind = binder().bind
+            scenarios = [(name, [(step, bind(step[0], step[1]))
+                                 for step in scenario_steps])
+                         for (name, scenario_steps) in feature["scenarios"]]
+            steps = pickle.dumps((feature, scenarios),
+                                 pickle.HIGHEST_PROTOCOL)
+            names = (feature["name"], _method_names(feature))
+            entry = entry[:3] + (index[0], names, steps)
+            self.dirty = True
+        self.data["features"][path] = entry
+        return entry[4] + (entry[5],)
+
+    def save(self):
+        if not self.dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump(self.data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+def _feature_paths(paths):
+    if isinstance(paths, str):
+        paths = [paths]
+    found = []
+    for path in paths:
+        if not os.path.isdir(path):
+            found.append(path)
+            continue
+        for (directory, dirs, files) in os.walk(path):
+            dirs.sort()
+            found.extend([os.path.join(directory, x) for x in sorted(files)
+                          if x.endswith(".feature")])
+    return [os.path.abspath(x) for x in found]
+
+def _identifier(name):
+    return re.sub(r"\W+", "_", name).strip("_").lower() or "unnamed"
+
+def _method_names(feature):
+    names = []
+    for (name, scenario_steps) in feature["scenarios"]:
+        base = "scenario_%s" % _identifier(name)
+        method_name = base
+        n = 2
+        while method_name in names:
+            method_name = "%s_%d" % (base, n)
+            n += 1
+        names.append(method_name)
+    return names
+
+
+class _FeatureSteps():
+    # the steps of the scenarios of a feature file, bound to the step
+    # functions of registry when the first of them runs
+    def __init__(self, path, steps, registry):
+        self.path = path
+        self._steps = steps
+        self._registry = registry
+        self._calls = None
+
+    def calls(self, index):
+        if self._calls is None:
+            functions = [x[2] for x in self._registry.steps]
+            (feature, scenarios) = pickle.loads(self._steps)
+            self._calls = [[self._call(step, binding, functions)
+                            for (step, binding) in scenario_steps]
+                           for (name, scenario_steps) in scenarios]
+        return self._calls[index]
+
+    def _call(self, step, binding, functions):
+        (kind, text, line, extra) = step
+        if binding is None:
+            return (None, "%s:%d: undefined step: %s %s"
+                    % (self.path, line, kind, text))
+        (position, params) = binding
+        return (functions[position], dict(params, **extra))
+
+
+class _ScenarioSteps():
+    # the scenario_ method of a scenario: calls its step functions
+    __slots__ = ("_feature", "_index", "__name__")
+
+    def __init__(self, feature, index, name):
+        self._feature = feature
+        self._index = index
+        self.__name__ = name
+
+    def __call__(self, given, when, then):
+        for (fn, params) in self._feature.calls(self._index):
+            if fn is None:
+                raise UndefinedStep(params)
+            fn(given, when, then, **params)
+
+
+def load_features(paths, module=None, cache=None, registry=None, base=None):
+    # {class name: BddTest subclass} of the .feature files in paths (a
+    # path, a directory, or a list of them). module is the name of the
+    # module the classes are put in, for ids and worker processes.
+    registry = registry or steps
+    base = base or BddTest
+    if cache is None:
+        cache = os.environ.get("SPICY_GHERKIN_CACHE") \
+            or ".spicy/gherkin.cache"
+    cache = FeatureCache(cache)
+    index = cache.index(registry)
+    binder = []
+    def get_binder():
+        # built only when a feature must be bound
+        if not binder:
+            binder.append(registry.binder(index))
+        return binder[0]
+
+    classes = {}
+    for path in _feature_paths(paths):
+        (title, names, data) = cache.feature(path, index, get_binder)
+        feature = _FeatureSteps(path, data, registry)
+        attrs = dict([(name, _ScenarioSteps(feature, i, name))
+                      for (i, name) in enumerate(names)])
+        attrs["__module__"] = module or __name__
+        title = title or os.path.splitext(os.path.basename(path))[0]
+        class_name = "Feature" + "".join(
+            [x.capitalize() for x in _identifier(title).split("_")])
+        while class_name in classes:
+            class_name += "_"
+        attrs["__qualname__"] = class_name
+        classes[class_name] = type(class_name, (base,), attrs)
+    cache.save()
+    return classes
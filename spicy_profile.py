@@ -0,0 +1,343 @@
+import os
+import sys
+import time
+import marshal
+import pstats
+import cProfile
+import sysconfig
+import threading
+import tracemalloc
+import collections
+
+# where the time of a suite goes: to the code under test or to spicy.
+#
+#   SPICY_PROFILE=cprofile python -m spicy_bdd spicy_test
+#   python -m spicy_bdd --profile sample spicy_test
+#
+# every scenario is profiled on its own, in the process which runs it,
+# by cProfile ("cprofile") or by a thread which samples its stack every
+# SPICY_PROFILE_INTERVAL seconds ("sample"). cProfile counts every call
+# but adds a cost to each, which makes code of many small calls, as the
+# DSL is, look slower than it is; the sampler only sees wall time, in
+# proportion. the profiles are added up over the suite and written at
+# exit to SPICY_PROFILE_DIR:
+#
+#   profile.pstats     all the functions, for pstats or snakeviz
+#   spicy.pstats       the functions of spicy itself
+#   user.pstats        the functions of the tests and the code they test
+#   profile.collapsed  "frame;frame;... microseconds" lines for
+#                      flamegraph.pl or speedscope, a root per class
+#
+# frames are labelled "group`file:function", where the group is spicy,
+# user or library (the standard library, site-packages and builtins).
+
+MODES = ("cprofile", "sample")
+
+_library = tuple(set([sysconfig.get_path(x) for x in
+                      ("stdlib", "platstdlib", "purelib", "platlib")]))
+
+
+def group(filename):
+    # imported here, as spicy_bdd imports this module as it loads
+    import spicy_bdd
+    if os.path.basename(filename) in spicy_bdd.FRAMEWORK:
+        return "spicy"
+    if filename == "~" or filename.startswith("<") \
+       or filename.startswith(_library):
+        return "library"
+    return "user"
+
+def label(key):
+    (filename, line, name) = key
+    if filename == "~":
+        return "library`%s" % name
+    return "%s`%s:%s" % (group(filename), os.path.basename(filename), name)
+
+
+def _own(key):
+    # frames of the profiler itself
+    return os.path.basename(key[0]) == "spicy_profile.py" \
+        or key[2] == "<method 'disable' of '_lsprof.Profiler' objects>"
+
+def _depth(frame):
+    depth = 0
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+def _spread(stats, threshold=1e-6):
+    # {stack: seconds} of cProfile stats. cProfile keeps who called whom,
+    # not stacks, so the time of a function is spread over the stacks of
+    # its callers in proportion to the time spent by each call site.
+    # shares below threshold, and recursive calls, stay with the caller.
+    callees = {}
+    for (fn, (cc, nc, tt, ct, callers)) in stats.items():
+        for (caller, edge) in callers.items():
+            callees.setdefault(caller, []).append((fn, edge[3]))
+    stacks = collections.defaultdict(float)
+    todo = [((fn,), entry[3]) for (fn, entry) in stats.items()
+            if not entry[4]]
+    while todo:
+        (path, seconds) = todo.pop()
+        (cc, nc, tt, ct, callers) = stats[path[-1]]
+        if ct <= 0:
+            stacks[path] += seconds
+            continue
+        share = seconds / ct
+        kept = seconds - tt * share
+        stacks[path] += tt * share
+        for (callee, edge_ct) in callees.get(path[-1], ()):
+            part = edge_ct * share
+            if part >= threshold and callee not in path:
+                todo.append((path + (callee,), part))
+                kept -= part
+        if kept > 0:
+            stacks[path] += kept
+    return stacks
+
+def _stats(stacks):
+    # pstats entries of sampled stacks. calls are counted in samples
+    stats = {}
+    for (stack, seconds) in stacks.items():
+        seen = set()
+        caller = None
+        for fn in stack:
+            entry = stats.setdefault(fn, [0, 0, 0.0, 0.0, {}])
+            if fn not in seen:
+                seen.add(fn)
+                entry[0] += 1
+                entry[1] += 1
+                entry[3] += seconds
+            if caller is not None:
+                edge = entry[4].setdefault(caller, [0, 0, 0.0, 0.0])
+                edge[0] += 1
+                edge[1] += 1
+                edge[3] += seconds
+            caller = fn
+        if stack:
+            stats[stack[-1]][2] += seconds
+            edges = stats[stack[-1]][4]
+            if len(stack) > 1:
+                edges[stack[-2]][2] += seconds
+    return dict([(fn, (cc, nc, tt, ct,
+                       dict([(k, tuple(v)) for (k, v) in callers.items()])))
+                 for (fn, (cc, nc, tt, ct, callers)) in stats.items()])
+
+
+class _Sampler():
+    # a thread which samples the stack of the thread running a scenario,
+    # weighing each sample by the time since the one before. it takes
+    # none while tracemalloc traces, as bench peaks do, and is parked by
+    # pause() for leak checks: its own allocations would be measured
+    # with the scenario's.
+    def __init__(self, interval):
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+        self._target = None
+
+    def start(self, depth):
+        if self._pid != os.getpid():
+            # threads do not survive a fork
+            self._pid = os.getpid()
+            self._active = threading.Event()
+            self._parked = threading.Event()
+            threading.Thread(target=self._run,
+                             args=(self._active, self._parked),
+                             name="spicy-profile", daemon=True).start()
+        stacks = collections.defaultdict(float)
+        self._target = (threading.get_ident(), depth, stacks)
+        self._active.set()
+        return stacks
+
+    def stop(self):
+        with self._lock:
+            self._active.clear()
+            self._target = None
+
+    def pause(self):
+        # returns once the thread waits for resume(), without waking up
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._active.clear()
+        self._parked.wait()
+
+    def resume(self):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            if self._target is not None:
+                self._active.set()
+
+    def _run(self, active, parked):
+        current_frames = sys._current_frames
+        clock = time.perf_counter
+        while True:
+            if not active.is_set():
+                parked.set()
+                active.wait()
+            parked.clear()
+            last = clock()
+            time.sleep(self.interval)
+            with self._lock:
+                if not active.is_set() or tracemalloc.is_tracing():
+                    continue
+                (ident, depth, stacks) = self._target
+                frame = current_frames().get(ident)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno,
+                                  getattr(code, "co_qualname", code.co_name)))
+                    frame = frame.f_back
+                # outermost first, from the first call of the scenario
+                stack = [x for x in reversed(stack[:len(stack) - depth])
+                         if not _own(x)]
+                stacks[tuple(stack)] += clock() - last
+
+
+class SuiteProfile():
+    # the profiles of the scenarios which ran, added up. scenarios which
+    # overlap (async ones, or suites run by a scenario) are part of the
+    # profile of the first one.
+    def __init__(self, mode="cprofile", directory=".spicy/profile",
+                 interval=0.001):
+        if mode not in MODES:
+            raise ValueError("unknown profile mode %r, expected one of %s"
+                             % (mode, ", ".join(MODES)))
+        self.mode = mode
+        self.directory = directory
+        self._sampler = _Sampler(interval) if mode == "sample" else None
+        self._busy = False
+        self._token = None
+        self.scenarios = 0
+        self.stats = {}
+        self.stacks = collections.defaultdict(float)
+
+    @classmethod
+    def from_env(cls):
+        mode = os.environ.get("SPICY_PROFILE")
+        if not mode:
+            return None
+        if mode == "1":
+            mode = "cprofile"
+        return cls(mode,
+                   os.environ.get("SPICY_PROFILE_DIR") or ".spicy/profile",
+                   float(os.environ.get("SPICY_PROFILE_INTERVAL") or 0.001))
+
+    def start(self):
+        # returns what stop() needs, or None when the scenario can't be
+        # profiled. the scenario is what the caller of start() calls next
+        if self._busy:
+            return None
+        if self._sampler is not None:
+            token = self._sampler.start(_depth(sys._getframe(1)))
+        else:
+            token = cProfile.Profile()
+            try:
+                token.enable()
+            except ValueError:
+                # another profiler, coverage say, is active
+                return None
+        self._busy = True
+        self._token = token
+        return token
+
+    def stop(self, token):
+        # (pstats entries, {stack of labels: seconds}) of the scenario,
+        # small enough to be sent back by a worker process
+        self._busy = False
+        self._token = None
+        if self._sampler is not None:
+            self._sampler.stop()
+            stacks = token
+            stats = _stats(stacks)
+        else:
+            token.disable()
+            token.create_stats()
+            stats = dict([(fn, (cc, nc, tt, ct,
+                                dict([x for x in callers.items()
+                                      if not _own(x[0])])))
+                          for (fn, (cc, nc, tt, ct, callers))
+                          in token.stats.items() if not _own(fn)])
+            stacks = _spread(stats)
+        labelled = collections.defaultdict(float)
+        for (stack, seconds) in stacks.items():
+            labelled[tuple([label(x) for x in stack])] += seconds
+        return (stats, dict(labelled))
+
+    def pause(self):
+        # while the profiled scenario measures itself, as leak checks do
+        if self._sampler is not None:
+            self._sampler.pause()
+        elif self._token is not None:
+            self._token.disable()
+
+    def resume(self):
+        if self._sampler is not None:
+            self._sampler.resume()
+        elif self._token is not None:
+            self._token.enable()
+
+    def record(self, test_id, profile):
+        (stats, stacks) = profile
+        self.scenarios += 1
+        for (fn, entry) in stats.items():
+            old = self.stats.get(fn)
+            self.stats[fn] = entry if old is None \
+                else pstats.add_func_stats(old, entry)
+        root = (test_id.rsplit(".", 1)[0],)
+        for (stack, seconds) in stacks.items():
+            self.stacks[root + tuple([sys.intern(x) for x in stack])] \
+                += seconds
+
+    def split(self):
+        # {group: seconds}. the time of library frames goes to the spicy
+        # or user frame which called them
+        totals = collections.defaultdict(float)
+        for (stack, seconds) in self.stacks.items():
+            owner = "library"
+            for frame in reversed(stack[1:]):
+                owner = frame.split("`", 1)[0]
+                if owner != "library":
+                    break
+            totals[owner] += seconds
+        return totals
+
+    def save(self, stream=None, top=10):
+        if not self.scenarios:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for (name, wanted) in (("profile", None), ("spicy", "spicy"),
+                               ("user", "user")):
+            stats = dict([(fn, entry) for (fn, entry) in self.stats.items()
+                          if wanted is None or fn[0] != "~"
+                          and group(fn[0]) == wanted])
+            with open(os.path.join(self.directory, name + ".pstats"),
+                      "wb") as f:
+                marshal.dump(stats, f)
+        with open(os.path.join(self.directory, "profile.collapsed"),
+                  "w") as f:
+            for (stack, seconds) in sorted(self.stacks.items()):
+                microseconds = int(round(seconds * 1e6))
+                if microseconds:
+                    f.write("%s %d\n" % (";".join(stack), microseconds))
+        self.report(stream, top)
+
+    def report(self, stream=None, top=10):
+        stream = stream or sys.stderr
+        totals = self.split()
+        total = sum(totals.values()) or 1
+        print("profile of %d scenarios (%s) in %s:" % (
+            self.scenarios, self.mode, self.directory), file=stream)
+        print("  " + ", ".join(["%s %.3fs (%.1f%%)" % (
+            name, totals[name], totals[name] * 100 / total)
+            for name in ("spicy", "user", "library") if name in totals]),
+              file=stream)
+        functions = sorted(self.stats.items(), key=lambda x: -x[1][2])
+        for (fn, (cc, nc, tt, ct, callers)) in functions[:top]:
+            print("  %10.3fs %10.3fs  %s" % (tt, ct, label(fn)),
+                  file=stream)
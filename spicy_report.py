@@ -0,0 +1,149 @@
+import os
+import re
+import json
+import time
+
+# where the outcome of every scenario goes, as soon as it is known:
+#
+#   --junit-xml FILE, SPICY_JUNIT_XML        JUnitXmlReporter
+#   --report-jsonl FILE, SPICY_REPORT_JSONL  JsonlReporter
+#   --timings FILE                           TimingsReporter
+#
+# spicy_bdd.reporters, a Reporters, writes a record of each scenario to
+# them: its id, description, outcome, message, spec and timing.
+
+
+class JsonlReporter():
+    # one json object per finished scenario, flushed at once so that a
+    # long run can be followed with tail -f
+    def __init__(self, path):
+        self._file = open(path, "w")
+
+    def write(self, record):
+        self._file.write(json.dumps(record, default=str) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# characters which XML 1.0 does not allow, even escaped
+_xml_invalid = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def _xml_text(text):
+    from xml.sax.saxutils import escape
+    return escape(_xml_invalid.sub("?", text))
+
+class JUnitXmlReporter():
+    # JUnit XML written one testcase at a time. the testsuite of a class
+    # is opened at its first scenario and closed at the next class, so
+    # it has no counts; JUnit consumers count the testcases themselves.
+    def __init__(self, path):
+        self._file = open(path, "w")
+        self._suite = None
+        self._file.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                         '<testsuites>\n')
+
+    def write(self, record):
+        # imported here, xml.sax imports most of urllib
+        from xml.sax.saxutils import quoteattr
+        (classname, _, name) = record["id"].rpartition(".")
+        out = []
+        if classname != self._suite:
+            if self._suite is not None:
+                out.append(' </testsuite>\n')
+            out.append(' <testsuite name=%s>\n' % quoteattr(classname))
+            self._suite = classname
+        out.append('  <testcase classname=%s name=%s time="%.6f">\n'
+                   % (quoteattr(classname),
+                      quoteattr(name),
+                      record["total"] or 0))
+        outcome = record["outcome"]
+        message = record["message"] or ""
+        if outcome in ("failure", "error"):
+            first = _xml_invalid.sub("?", message.strip().split("\n")[-1])
+            out.append('   <%s message=%s>%s</%s>\n'
+                       % (outcome, quoteattr(first), _xml_text(message),
+                          outcome))
+        elif outcome == "skip":
+            out.append('   <skipped message=%s/>\n'
+                       % quoteattr(_xml_invalid.sub("?", message)))
+        if record["spec"]:
+            out.append('   <system-out>%s</system-out>\n'
+                       % _xml_text(record["spec"]))
+        out.append('  </testcase>\n')
+        self._file.write("".join(out))
+        self._file.flush()
+
+    def close(self):
+        if self._suite is not None:
+            self._file.write(' </testsuite>\n')
+        self._file.write('</testsuites>\n')
+        self._file.close()
+
+
+class TimingsReporter():
+    # the timings of --timings, written as scenarios finish rather than
+    # kept until the end:
+    #
+    #   {"version": 1, "scenarios": [{"id": ..., "description": ...,
+    #    "setup": ..., "body": ..., "teardown": ..., "total": ...}, ...]}
+    def __init__(self, path):
+        self._file = open(path, "w")
+        self._file.write('{"version": 1, "scenarios": [')
+        self._separator = "\n"
+
+    def write(self, record):
+        if record["setup"] is None and record["body"] is None:
+            return
+        timing = dict([(k, record[k]) for k in
+                       ("id", "description", "setup", "body", "teardown",
+                        "total")])
+        self._file.write(self._separator + json.dumps(timing))
+        self._separator = ",\n"
+
+    def close(self):
+        self._file.write("\n]}\n")
+        self._file.close()
+
+
+class Reporters():
+    # writes the outcome of every scenario to the configured reporters as
+    # soon as it is known, so that nothing but counts has to stay in
+    # memory until the end of a run. busy while a BddTest class reports,
+    # so that suites run by its scenarios are not reported.
+    def __init__(self):
+        self.enabled = False
+        self.busy = False
+        self._reporters = []
+
+    def configure(self, reporters=()):
+        for reporter in self._reporters:
+            if reporter not in reporters:
+                reporter.close()
+        self._reporters = list(reporters)
+        self.enabled = bool(self._reporters)
+
+    def configure_from_env(self):
+        reporters = []
+        if os.environ.get("SPICY_JUNIT_XML"):
+            reporters.append(JUnitXmlReporter(os.environ["SPICY_JUNIT_XML"]))
+        if os.environ.get("SPICY_REPORT_JSONL"):
+            reporters.append(JsonlReporter(os.environ["SPICY_REPORT_JSONL"]))
+        self.configure(reporters)
+
+    def report(self, test, outcome, message=None):
+        record = {"id": test.id(),
+                  "description": getattr(test, "description", None),
+                  "outcome": outcome,
+                  "message": message,
+                  "spec": getattr(test, "spec", None),
+                  "time": time.time()}
+        timing = getattr(test, "timing", None)
+        if timing is None:
+            import spicy_bdd
+            timing = spicy_bdd.ScenarioTiming()
+        record.update(timing.as_dict())
+        for reporter in self._reporters:
+            reporter.write(record)
+
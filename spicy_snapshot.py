@@ -0,0 +1,256 @@
+import os
+import mmap
+import atexit
+import json
+import struct
+import hashlib
+import collections
+import multiprocessing.util
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# named snapshots for the match_snapshot matcher, all in one file:
+#
+#   header  magic, and the offset and size of the current index
+#   blobs   payloads, each stored once by content (sha1)
+#   index   digest, offset, length, kind and name of every snapshot
+#
+# readers map the file and parse the index only. a matching snapshot is
+# found by its digest, and a payload is read through the map, without
+# a copy, only to describe a mismatch. new snapshots are kept in memory
+# until flush(), after each BddTest class run and at exit, which appends
+# their blobs and one index under a lock, then points the header at them.
+
+MAGIC = b"SPYSNAP1"
+_header = struct.Struct("<8sQQ")
+_entry = struct.Struct("<20sQQcH")
+
+Entry = collections.namedtuple("Entry", "digest offset length kind")
+
+
+def encode(value):
+    # (kind, payload) of a value. bytes-like values are not copied
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return (b"b", memoryview(value).cast("B"))
+    if isinstance(value, str):
+        return (b"s", value.encode("utf-8"))
+    return (b"j", json.dumps(value, indent=1, sort_keys=True,
+                             default=repr).encode("utf-8"))
+
+def decode(kind, payload):
+    if kind == b"b":
+        return bytes(payload)
+    if kind == b"s":
+        return str(payload, "utf-8")
+    return json.loads(bytes(payload))
+
+
+def _pack_index(index):
+    parts = []
+    for (name, e) in index.items():
+        name = name.encode("utf-8")
+        parts.append(_entry.pack(e.digest, e.offset, e.length, e.kind,
+                                 len(name)))
+        parts.append(name)
+    return b"".join(parts)
+
+def _identity(st):
+    # what tells that the file changed since it was read
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def _parse_index(data, offset, size):
+    index = {}
+    end = offset + size
+    while offset < end:
+        (d, start, length, kind, n) = _entry.unpack_from(data, offset)
+        offset += _entry.size
+        name = str(data[offset:offset + n], "utf-8")
+        offset += n
+        index[name] = Entry(d, start, length, kind)
+    return index
+
+
+class SnapshotStore():
+    # one store per path and process, opened lazily
+    _stores = {}
+    _flushed_by = None
+
+    @classmethod
+    def open(cls, path):
+        if cls._flushed_by != os.getpid():
+            # workers of a process pool exit without running atexit, but
+            # with the finalizers of multiprocessing
+            cls._flushed_by = os.getpid()
+            atexit.register(cls.flush_all)
+            multiprocessing.util.Finalize(None, cls.flush_all, exitpriority=0)
+        path = os.path.abspath(path)
+        store = cls._stores.get(path)
+        if store is None:
+            store = cls._stores[path] = cls(path)
+        return store
+
+    @classmethod
+    def flush_all(cls):
+        for store in cls._stores.values():
+            store.flush()
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._index = None
+        self._stat = None
+        # {name: Entry} not written yet, their offsets None, and their
+        # payloads by digest
+        self._pending = {}
+        self._blobs = {}
+
+    def _load(self):
+        if self._index is None:
+            try:
+                fd = os.open(self.path, os.O_RDONLY)
+            except FileNotFoundError:
+                self._index = {}
+                return self._index
+            try:
+                self._read(fd)
+            finally:
+                os.close(fd)
+        return self._index
+
+    def _read(self, fd):
+        # maps the file and parses its index; the map outlives the fd
+        self._map = None
+        self._index = {}
+        self._stat = _identity(os.fstat(fd))
+        if self._stat[1] < _header.size:
+            return
+        data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        (magic, offset, size) = _header.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("%s is not a snapshot store" % self.path)
+        self._map = data
+        self._index = _parse_index(data, offset, size)
+
+    def get(self, name):
+        entry = self._pending.get(name) or self._load().get(name)
+        if entry is None and self._changed():
+            # another process added to it since the file was read
+            self._index = None
+            entry = self._load().get(name)
+        return entry
+
+    def _changed(self):
+        try:
+            return _identity(os.stat(self.path)) != self._stat
+        except FileNotFoundError:
+            return False
+
+    def payload(self, entry):
+        # a view of the stored payload in the map, not a copy
+        if entry.offset is None:
+            return memoryview(self._blobs[entry.digest])
+        return memoryview(self._map)[entry.offset:entry.offset + entry.length]
+
+    def names(self):
+        return list(set(self._load()) | set(self._pending))
+
+    def check(self, name, value, update=False):
+        # None when the snapshot of name matches value, else its Entry.
+        # a missing snapshot, or with update a different one, is stored.
+        (kind, payload) = encode(value)
+        digest = hashlib.sha1(payload).digest()
+        entry = self.get(name)
+        if entry is not None and entry.digest == digest \
+           and entry.kind == kind:
+            return None
+        if entry is None or update:
+            self.put(name, kind, payload, digest)
+            return None
+        return entry
+
+    def _lock(self):
+        # an exclusive lock on the file at path, which compaction may
+        # have replaced while this process waited for it
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is None:
+                return fd
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def put(self, name, kind, payload, digest):
+        self._blobs[digest] = bytes(payload)
+        self._pending[name] = Entry(digest, None, len(payload), kind)
+
+    def flush(self):
+        # writes the pending snapshots, their blobs then one index
+        if not self._pending:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = self._lock()
+        try:
+            self._read(fd)
+            index = self._index
+            end = max(os.fstat(fd).st_size, _header.size)
+            # the same content under another name is stored once
+            stored = dict([((x.digest, x.length), x.offset)
+                           for x in index.values()])
+            blobs = []
+            for (name, e) in self._pending.items():
+                offset = stored.get((e.digest, e.length))
+                if offset is None:
+                    offset = stored[(e.digest, e.length)] = end
+                    blobs.append(self._blobs[e.digest])
+                    end += e.length
+                index[name] = Entry(e.digest, offset, e.length, e.kind)
+            packed = _pack_index(index)
+            os.pwrite(fd, b"".join(blobs) + packed,
+                      end - sum(map(len, blobs)))
+            # the header last, so that readers never see a partial index
+            os.pwrite(fd, _header.pack(MAGIC, end, len(packed)), 0)
+            self._pending = {}
+            self._blobs = {}
+
+            # old indexes and replaced blobs
+            live = dict([(x.offset, x.length) for x in index.values()])
+            size = end + len(packed)
+            if size - _header.size - len(packed) - sum(live.values()) \
+               > size // 2:
+                self._read(fd)
+                self._compact(index)
+        finally:
+            os.close(fd)
+        # mapped again when next read
+        self._index = None
+
+    def _compact(self, index):
+        # rewrites the live blobs and the index into a new file, which
+        # replaces the old one. called with the lock held.
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        data = self._map
+        moved = {}
+        compacted = {}
+        with open(tmp, "wb") as f:
+            f.write(bytes(_header.size))
+            for (name, e) in index.items():
+                offset = moved.get(e.offset)
+                if offset is None:
+                    offset = moved[e.offset] = f.tell()
+                    f.write(data[e.offset:e.offset + e.length])
+                compacted[name] = Entry(e.digest, offset, e.length, e.kind)
+            end = f.tell()
+            packed = _pack_index(compacted)
+            f.write(packed)
+            f.seek(0)
+            f.write(_header.pack(MAGIC, end, len(packed)))
+        os.replace(tmp, self.path)
@@ -0,0 +1,218 @@
+import time
+import random
+import string
+import itertools
+
+# the strategies of property scenarios, as in given(n=integers(0, 10)),
+# and the shrinking of failing examples. a strategy draws its value from
+# Choices, so that an example is replayed, and simplified, by replaying
+# an edited sequence of its choices.
+
+
+class Overrun(Exception):
+    # an example drew more choices than any sensible input needs
+    pass
+
+
+class Choices():
+    # the choice sequence strategies draw from: a list of ints which
+    # replays a generated example exactly, and which shrinking edits. a
+    # choice of 0 is always the simplest one. past the end of the prefix,
+    # choices are random, or 0 when there is no rng (while shrinking).
+    # seed, a function returning the seed of the rng, lets scenarios
+    # which draw nothing skip making one.
+    max_size = 8192
+
+    def __init__(self, prefix=(), rng=None, seed=None):
+        self.prefix = prefix
+        self.rng = rng
+        self.seed = seed
+        self.values = []
+        # (name, value) of every given drawn from a strategy
+        self.drawn = []
+
+    def draw(self, n, p=None):
+        # an int in [0, n). p is the chance of a 1 for a random flag
+        i = len(self.values)
+        if i >= self.max_size:
+            raise Overrun()
+        if self.rng is None and self.seed is not None:
+            self.rng = random.Random(self.seed())
+        if i < len(self.prefix):
+            c = min(self.prefix[i], n - 1)
+        elif self.rng is None:
+            c = 0
+        elif p is not None:
+            c = int(self.rng.random() < p)
+        else:
+            # edge cases are far more likely than a uniform draw finds
+            r = self.rng.random()
+            if r < 0.2:
+                c = self.rng.randrange(min(n, 16))
+            elif r < 0.25:
+                c = n - 1
+            else:
+                c = self.rng.randrange(n)
+        self.values.append(c)
+        return c
+
+
+class Strategy():
+    # generates given values: given(a=integers(0, 10)) makes the scenario
+    # run over many values of a, and shrink the ones which fail
+    types = set()
+    created = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Strategy.types.add(cls)
+
+    def __new__(cls, *args, **kwargs):
+        Strategy.created = True
+        return super().__new__(cls)
+
+    def draw(self, choices):
+        raise NotImplementedError()
+
+    def map(self, fn):
+        return _Mapped(self, fn)
+
+class _Mapped(Strategy):
+    def __init__(self, strategy, fn):
+        self.strategy = strategy
+        self.fn = fn
+
+    def draw(self, choices):
+        return self.fn(self.strategy.draw(choices))
+
+class _Integers(Strategy):
+    def __init__(self, min_value, max_value):
+        if min_value > max_value:
+            raise ValueError("empty range %d..%d" % (min_value, max_value))
+        self.min_value = min_value
+        self.max_value = max_value
+        # values shrink towards 0, or the bound nearest to it
+        self.origin = max(min_value, min(0, max_value))
+
+    def draw(self, choices):
+        c = choices.draw(self.max_value - self.min_value + 1)
+        above = self.max_value - self.origin
+        if c <= above:
+            return self.origin + c
+        return self.origin - (c - above)
+
+class _Sampled(Strategy):
+    def __init__(self, values):
+        self.values = list(values)
+        if not self.values:
+            raise ValueError("nothing to sample from")
+
+    def draw(self, choices):
+        return self.values[choices.draw(len(self.values))]
+
+class _Lists(Strategy):
+    def __init__(self, elements, min_size, max_size):
+        self.elements = elements
+        self.min_size = min_size
+        self.max_size = max_size
+        average = min_size + min(max_size - min_size, 5)
+        self.more = 1 - 1 / (1 + average)
+
+    def draw(self, choices):
+        # every element is preceded by a "one more" flag, so dropping the
+        # flag and the element's choices removes it from the list
+        values = [self.elements.draw(choices) for i in range(self.min_size)]
+        while len(values) < self.max_size and choices.draw(2, self.more):
+            values.append(self.elements.draw(choices))
+        return values
+
+class _Tuples(Strategy):
+    def __init__(self, strategies):
+        self.strategies = strategies
+
+    def draw(self, choices):
+        return tuple([x.draw(choices) for x in self.strategies])
+
+class _Builds(Strategy):
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def draw(self, choices):
+        args = [x.draw(choices) for x in self.args]
+        kwargs = dict([(k, v.draw(choices)) for (k, v) in self.kwargs.items()])
+        return self.fn(*args, **kwargs)
+
+def integers(min_value=-(1 << 63), max_value=(1 << 63) - 1):
+    return _Integers(min_value, max_value)
+
+def booleans():
+    return _Sampled([False, True])
+
+def sampled_from(values):
+    return _Sampled(values)
+
+def lists(elements, min_size=0, max_size=20):
+    return _Lists(elements, min_size, max_size)
+
+def text(alphabet=string.printable, min_size=0, max_size=20):
+    return _Lists(_Sampled(alphabet), min_size, max_size).map("".join)
+
+def tuples(*strategies):
+    return _Tuples(strategies)
+
+def builds(fn, *args, **kwargs):
+    # a composite: fn called with values drawn from the strategies
+    return _Builds(fn, args, kwargs)
+
+
+def _shrink_candidates(values):
+    # choice sequences simpler than values, the ones which simplify the
+    # most first: without a block of choices, with a choice set to 0,
+    # with a choice halved or one less, then with part of a choice moved
+    # to a later one
+    n = len(values)
+    for size in (8, 4, 2, 1):
+        for i in range(n - size, -1, -1):
+            yield values[:i] + values[i + size:]
+    for i in range(n):
+        if values[i]:
+            yield values[:i] + [0] + values[i + 1:]
+    for i in range(n):
+        if values[i] > 2:
+            yield values[:i] + [values[i] // 2] + values[i + 1:]
+        if values[i] > 1:
+            yield values[:i] + [values[i] - 1] + values[i + 1:]
+    # moving an amount to a later choice keeps a sum the same
+    for i in range(n):
+        for j in range(i + 1, min(n, i + 5)):
+            for amount in set([values[i], values[i] // 2]):
+                if amount:
+                    candidate = list(values)
+                    candidate[i] -= amount
+                    candidate[j] += amount
+                    yield candidate
+
+def _simpler(a, b):
+    return (len(a), a) < (len(b), b)
+
+def shrink(values, replay, batch, deadline):
+    # replay(candidates) returns the choices which a failing candidate
+    # consumed, for the first one which fails, or None. a batch of
+    # candidates is tried at once, possibly in parallel.
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        candidates = _shrink_candidates(values)
+        while time.monotonic() < deadline:
+            chunk = list(itertools.islice(candidates, batch))
+            if not chunk:
+                break
+            smaller = replay(chunk)
+            if smaller is not None and _simpler(smaller, values):
+                values = smaller
+                improved = True
+                break
+    return values
+
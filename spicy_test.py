@@ -1,12 +1,69 @@
 import unittest
-from spicy_bdd import BddTest
+import os
+import sys
+import tempfile
+import shutil
+import types
+import asyncio
+import json
+import time
+import io
+import pstats
+import spicy_bench
+import spicy_bdd
+import spicy_watch
+import spicy_gherkin
+import spicy_profile
+import spicy_snapshot
+from spicy_bdd import BddTest, examples, csv_rows, factory
+from spicy_bdd import integers, lists, text, builds
+
+# built by the inline factories of scenario_build_inline_factories_once
+inline_builds = []
+
+
+def _run_suite(test):
+    result = unittest.TestResult()
+    test.run(result)
+    return result
+
+
+def _run_reported(test, *reporters):
+    # runs test as a top level run would, writing to reporters only, and
+    # closes them. the reporters of the outer run are left alone.
+    saved = (spicy_bdd.reporters._reporters, spicy_bdd.reporters.busy)
+    spicy_bdd.reporters._reporters = list(reporters)
+    spicy_bdd.reporters.enabled = True
+    spicy_bdd.reporters.busy = False
+    try:
+        return _run_suite(test)
+    finally:
+        (spicy_bdd.reporters._reporters, spicy_bdd.reporters.busy) = saved
+        spicy_bdd.reporters.enabled = bool(saved[0])
+        for reporter in reporters:
+            reporter.close()
+
+
+class InProcess():
+    # inner test classes run here, whatever SPICY_WORKERS and
+    # SPICY_ISOLATION say
+    workers = 1
+    isolation = False
+
+
+class TempDirMixin():
+    def temp_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
 
 class TestStorage(dict):
     def append(self, key, value):
         self[key] = value
 
 
-class BddTestTest(BddTest):
+class BddTestTest(TempDirMixin, BddTest):
     def scenario_add_two_numbers(self, given, when, then):
         given(add=lambda x, y: x + y,
               a=1,
@@ -52,6 +109,740 @@ class BddTestTest(BddTest):
         when.fn1()
         then.fn2().should._raise(AttributeError)\
             ._and.fn1().should.not_raise(AttributeError)
-        
+
+    def scenario_start_new_chain_after_and(self, given, when, then):
+        given(add=lambda x, y: x + y,
+              the_list=[])
+        for i in range(3):
+            when.add(i, 1)._and.the_list.append(i)
+            then.the_list.length.should.equal(i + 1)
+
+    def scenario_check_performance_budget(self, given, when, then):
+        given(build=lambda n: list(range(n)))
+        when.build(100)
+        then.it.should.complete_within(s=1)\
+            ._and.the.value.should.allocate_at_most(mb=1)\
+            ._and.the.value.should.sustain(ops_per_sec=10, seconds=0.05)
+
+    def scenario_check_operation_does_not_leak(self, given, when, then):
+        given(copy=list, value=[0] * 100)
+        when.copy(given.value)
+        then.it.should.not_leak()
+
+    def scenario_find_growing_memory(self, given, when, then):
+        cache = []
+        class Leaking(InProcess, BddTest):
+            leak_check = 5
+            def scenario_keep_values(self, given, when, then):
+                cache.append(bytearray(4096))
+            def scenario_keep_a_few_bytes(self, given, when, then):
+                cache.append(object())
+            def scenario_keep_nothing(self, given, when, then):
+                given(value=[0] * 100)
+                then.value.length.should.equal(100)
+        class Allowed(InProcess, BddTest):
+            leak_check = 5
+            leak_allowance = 1 << 16
+            def scenario_keep_allowed_values(self, given, when, then):
+                cache.append(bytearray(4096))
+        class Growing(InProcess, BddTest):
+            def scenario_grow_cache(self, given, when, then):
+                given(keep=lambda: cache.append({}))
+                when.keep()
+                then.it.should.not_leak(runs=5)
+        given(failed=lambda test: sorted(
+                  [(x.id().split(".")[-1], "spicy_test.py:" in str(e))
+                   for (x, e) in _run_suite(test).failures]))
+        when.failed(unittest.TestSuite([Leaking(), Allowed(), Growing()]))
+        then.it.should.equal([("scenario_grow_cache", True),
+                              ("scenario_keep_a_few_bytes", True),
+                              ("scenario_keep_values", True)])
+
+    def scenario_store_new_snapshots_at_once(self, given, when, then):
+        directory = self.temp_dir()
+        path = os.path.join(directory, "snapshots.bin")
+        class Snapshots(InProcess, BddTest):
+            snapshot_store = path
+            def scenario_render(self, given, when, then):
+                given(rows=list(range(10)))
+                for i in range(40):
+                    then.rows.should.match_snapshot()
+        def stored(test):
+            _run_suite(test)
+            store = spicy_snapshot.SnapshotStore(path)
+            names = store.names()
+            index = spicy_snapshot._pack_index(store._index)
+            # the blob, stored once, and a single index
+            extra = os.path.getsize(path) - spicy_snapshot._header.size \
+                - len(index) - store.get(names[0]).length
+            return "%d %s %d" % (len(names), sorted(names)[0], extra)
+        given(stored=stored, test=Snapshots())
+        when.stored(given.test)
+        then.it.should.have.property(
+            "40 spicy_test.py:BddTestTest.scenario_store_new_snapshots_at_once"
+            ".<locals>.Snapshots.scenario_render 1 0")
+
+    def scenario_report_only_outer_scenarios(self, given, when, then):
+        directory = self.temp_dir()
+        path = os.path.join(directory, "report.jsonl")
+        class Inner(InProcess, BddTest):
+            def scenario_fail(self, given, when, then):
+                then.it.should.equal(1)
+        class Outer(InProcess, BddTest):
+            def scenario_run_failing_suite(self, given, when, then):
+                given(run=_run_suite, test=Inner())
+                when.run(given.test)
+                then.it.failures.length.should.equal(1)
+        def reported(test):
+            _run_reported(test, spicy_bdd.JsonlReporter(path))
+            with open(path) as f:
+                records = [json.loads(x) for x in f]
+            return [(x["id"].split(".")[-1], x["outcome"]) for x in records]
+        given(reported=reported, test=Outer())
+        when.reported(given.test)
+        then.it.should.equal([("scenario_run_failing_suite", "success")])
+
+    def scenario_check_leaks_while_tracing(self, given, when, then):
+        directory = self.temp_dir()
+        self.addCleanup(spicy_bdd.tracer.configure, spicy_bdd.tracer.sink)
+        spicy_bdd.tracer.configure(spicy_bdd.JsonlTraceSink(
+            os.path.join(directory, "trace.jsonl")))
+        class Clean(InProcess, BddTest):
+            leak_check = 5
+            def scenario_copy(self, given, when, then):
+                given(copy=list, value=[0] * 100)
+                when.copy(given.value)
+                then.it.should.not_leak()
+        given(run=_run_suite, test=Clean())
+        when.run(given.test)
+        then.it.failures.length.should.equal(0)
+
+    def scenario_match_stored_snapshots(self, given, when, then):
+        directory = self.temp_dir()
+        report = {"title": "report", "rows": list(range(100))}
+        class Snapshots(InProcess, BddTest):
+            snapshot_store = os.path.join(directory, "snapshots.bin")
+            def scenario_render(self, given, when, then):
+                given(report=report, render=lambda x: json.dumps(x, indent=1))
+                when.render(given.report)
+                then.it.should.match_snapshot()
+                then.report.should.match_snapshot()
+        def run_and_change(test):
+            _run_suite(test)
+            report["rows"][50] = -1
+            (failure,) = _run_suite(test).failures
+            return str(failure[1])
+        given(run_and_change=run_and_change, test=Snapshots())
+        when.run_and_change(given.test)
+        then.it.should.have.property("differ at index 53")
+
+    def scenario_run_gherkin_features(self, given, when, then):
+        directory = self.temp_dir()
+        with open(os.path.join(directory, "add.feature"), "w") as f:
+            f.write("Feature: Adding\n"
+                    "  Background:\n"
+                    "    Given an adder\n"
+                    "  Scenario Outline: add numbers\n"
+                    "    When I add <a> and <b>\n"
+                    "    Then the result is <sum>\n"
+                    "    Examples:\n"
+                    "      | a | b | sum |\n"
+                    "      | 1 | 2 | 3   |\n"
+                    "      | 2 | 5 | 7   |\n"
+                    "  Scenario: divide numbers\n"
+                    "    When I divide 1 by 2\n")
+        registry = spicy_gherkin.StepRegistry()
+        registry.add("given", "an adder",
+                     lambda given, when, then: given(add=lambda x, y: x + y))
+        registry.add("when", "I add {a:d} and {b:d}",
+                     lambda given, when, then, a, b: when.add(a, b))
+        registry.add("then", "the result is {n:d}",
+                     lambda given, when, then, n: then.it.should.equal(n))
+        class Base(InProcess, BddTest):
+            pass
+        def load_and_run():
+            # the second load comes from the cache
+            for i in range(2):
+                classes = spicy_gherkin.load_features(
+                    directory, cache=os.path.join(directory, "cache"),
+                    registry=registry, base=Base)
+            result = _run_suite(classes["FeatureAdding"]())
+            ((test, error),) = result.errors
+            return "%d run: %s" % (result.testsRun, error.splitlines()[-1])
+        given(load_and_run=load_and_run)
+        when.load_and_run()
+        then.it.should.have.property("3 run: ")
+        then.it.should.have.property("add.feature:12: undefined step")
+
+    def scenario_profile_scenarios(self, given, when, then):
+        directory = self.temp_dir()
+        class Profiled(InProcess, BddTest):
+            def scenario_add(self, given, when, then):
+                given(add=lambda x, y: x + y)
+                when.add(1, 2)
+                then.it.should.equal(3)
+        def profile():
+            saved = spicy_bdd.profiler
+            spicy_bdd.profiler = spicy_profile.SuiteProfile(
+                "cprofile", directory)
+            try:
+                _run_suite(Profiled())
+                spicy_bdd.profiler.save(io.StringIO())
+            finally:
+                spicy_bdd.profiler = saved
+            functions = {}
+            for name in ("spicy", "user"):
+                stats = pstats.Stats(os.path.join(directory,
+                                                  name + ".pstats"))
+                functions[name] = sorted(set([x[2] for x in stats.stats])
+                                         & set(["_eval", "scenario_add"]))
+            with open(os.path.join(directory, "profile.collapsed")) as f:
+                stacks = [x.rsplit(" ", 1)[0].split(";") for x in f]
+            functions["roots"] = sorted(set([x[0] for x in stacks]))
+            functions["user"] += sorted(set([x for stack in stacks
+                                             for x in stack
+                                             if x.startswith("user`")]))
+            return functions
+        given(profile=profile)
+        when.profile()
+        then.it.should.equal({
+            "spicy": ["_eval"],
+            "user": ["scenario_add", "user`spicy_test.py:scenario_add"],
+            "roots": [type(self).__module__ + ".BddTestTest."
+                      "scenario_profile_scenarios.<locals>.Profiled"]})
+
+    def scenario_build_inline_factories_once(self, given, when, then):
+        name = "session"
+        def build_session():
+            # a closure, keyed by itself: a new session value every run
+            inline_builds.append(name)
+        class Inline(InProcess, BddTest):
+            def scenario_a(self, given, when, then):
+                # a new lambda every run, capturing nothing
+                given(shared=factory(lambda: inline_builds.append("class"),
+                                     "class"),
+                      session=factory(build_session, "session"))
+                then.shared.should.equal(None)
+                then.session.should.equal(None)
+            scenario_b = scenario_a
+            scenario_c = scenario_a
+        def run(test):
+            del inline_builds[:]
+            _run_suite(test)
+            return sorted(inline_builds)
+        given(run=run, test=Inline())
+        when.run(given.test)
+        then.it.should.equal(["class", "session"])
+
+    def scenario_discover_scenarios_of_mixins(self, given, when, then):
+        class Shared():
+            def scenario_shared(self, given, when, then):
+                pass
+        class Mixed(Shared, InProcess, BddTest):
+            def scenario_own(self, given, when, then):
+                pass
+        given(run=_run_suite, test=Mixed())
+        when.run(given.test)
+        then.it.testsRun.should.equal(2)
+
+    def scenario_discover_scenario_added_later(self, given, when, then):
+        class Dynamic(BddTest):
+            def scenario_first(self, given, when, then):
+                pass
+        def add_scenario():
+            Dynamic.scenario_added_later = Dynamic.scenario_first
+        given(table=Dynamic._method_table,
+              add_scenario=add_scenario,
+              cached=Dynamic._method_table('scenario_'))
+        when.add_scenario()
+        then.table('scenario_').should.equal({
+            'scenario_added_later': 'Added Later',
+            'scenario_first': 'First'})
+
+    def scenario_run_local_class_with_workers(self, given, when, then):
+        # a local class can't be sent to pool workers, so it runs here,
+        # and the concurrent runner replays its error as it was raised
+        class Local(BddTest):
+            workers = 2
+            isolation = False
+            async_concurrency = 4
+            def scenario_pass(self, given, when, then):
+                pass
+            def scenario_raise(self, given, when, then):
+                {}["missing"]
+        def run(test):
+            result = _run_suite(test)
+            ((x, error),) = result.errors
+            return "%d run: %s" % (result.testsRun, error)
+        given(run=run, test=Local())
+        when.run(given.test)
+        then.it.should.have.property("2 run: Traceback (most recent call")
+        then.it.should.have.property("\nKeyError: 'missing'\n")
+
+    def scenario_record_timing_of_each_scenario(self, given, when, then):
+        class Timed(InProcess, BddTest):
+            def scenario_first(self, given, when, then):
+                pass
+            def scenario_second(self, given, when, then):
+                pass
+        given(run=_run_suite, test=Timed())
+        when.run(given.test)
+        then.it.scenario_timings.length.should.equal(2)
+
+    def scenario_keep_bounded_failures_and_timings(self, given, when, then):
+        directory = self.temp_dir()
+        path = os.path.join(directory, "timings.json")
+        class Failing(InProcess, BddTest):
+            pass
+        for i in range(5):
+            setattr(Failing, "scenario_fail_%d" % i,
+                    lambda self, given, when, then: self.fail("failed"))
+        def run(test):
+            saved = (spicy_bdd.BddTestResult.max_failures,
+                     spicy_bdd.BddTestResult.slowest_kept)
+            spicy_bdd.BddTestResult.max_failures = 2
+            spicy_bdd.BddTestResult.slowest_kept = 3
+            try:
+                result = _run_reported(test, spicy_bdd.TimingsReporter(path))
+            finally:
+                (spicy_bdd.BddTestResult.max_failures,
+                 spicy_bdd.BddTestResult.slowest_kept) = saved
+            return (len(result.failures), list.__len__(result.failures),
+                    len(result.scenario_timings),
+                    len(list(result.scenario_timings)),
+                    len(spicy_bdd.load_timings(path)))
+        given(run=run, test=Failing())
+        when.run(given.test)
+        then.it.should.equal((5, 2, 5, 3, 5))
+
+    def scenario_skip_property_scenario(self, given, when, then):
+        runs = []
+        class Skipping(InProcess, BddTest):
+            def scenario_skip(self, given, when, then):
+                given(n=integers(0, 10))
+                runs.append(given.n.value)
+                self.skipTest("not today")
+        def run(test):
+            # skipped at once, not explored and shrunk as a failure
+            result = _run_suite(test)
+            return (len(result.skipped), len(result.failures), len(runs))
+        given(run=run, test=Skipping())
+        when.run(given.test)
+        then.it.should.equal((1, 0, 1))
+
+    def scenario_stream_examples_from_csv(self, given, when, then):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv",
+                                         delete=False) as f:
+            f.write("a,b,sum\n1,2,3\n2,2,4\n5,5,10\n")
+        self.addCleanup(os.remove, f.name)
+
+        class FromCsv(InProcess, BddTest):
+            @examples(csv_rows(f.name))
+            def scenario_add(self, given, when, then):
+                given(add=lambda x, y: str(int(x) + int(y)))
+                when.add(given.a, given.b)
+                then.it.should.equal(given.sum)
+        given(run=_run_suite, test=FromCsv())
+        when.run(given.test)
+        then.it.testsRun.should.equal(3)
+        then.it.wasSuccessful().should.be.true()
+
+    def scenario_summarise_big_values_in_failures(self, given, when, then):
+        class Big(InProcess, BddTest):
+            def scenario_compare(self, given, when, then):
+                given(numbers=list(range(5000)))
+                then.numbers.should.equal(list(range(4999)) + [-1])
+        given(message=lambda test: str(_run_suite(test).failures[0][1]))
+        when.message(Big())
+        then.it.should.have.property("differ at index 4999")\
+            ._and.the.value.should.have.property("18, 19, ...]")\
+            ._and.the.value.length.should.be.less_than(1000)
+
+    def scenario_match_large_collections(self, given, when, then):
+        given(numbers=list(range(100000)),
+              shuffled=list(range(99999, -1, -1)),
+              data=bytearray(1000000))
+        then.numbers.should.contain_all(*range(0, 100000, 7))\
+            ._and.the.value.should.have.property(99999)\
+            ._and.the.value.should.be.sorted()\
+            ._and.the.value.should.have.no_duplicates()\
+            ._and.the.value.should.have.same_elements_as(given.shuffled)
+        then.shuffled.should.be.sorted(reverse=True)
+        then.data.should.equal(bytearray(1000000))
+
+    def scenario_stream_outcomes_to_reporters(self, given, when, then):
+        with tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False) as f:
+            path = f.name
+        self.addCleanup(os.remove, path)
+        class Reported(InProcess, BddTest):
+            def scenario_pass(self, given, when, then):
+                given(value=1)
+                then.value.should.equal(1)
+            def scenario_fail(self, given, when, then):
+                given(value=1)
+                then.value.should.equal(2)
+        def run(test):
+            _run_reported(test, spicy_bdd.JsonlReporter(path))
+            with open(path) as f:
+                return [json.loads(line)["outcome"] for line in f]
+        given(run=run, test=Reported())
+        when.run(given.test)
+        then.it.should.equal(["failure", "success"])
+
+    def scenario_split_scenarios_across_shards(self, given, when, then):
+        class Fake():
+            def __init__(self, name):
+                self.name = name
+            def id(self):
+                return self.name
+        names = ["test%d" % i for i in range(40)]
+        durations = dict([(name, i + 1) for (i, name) in enumerate(names)
+                          if i % 4])
+        def split(count):
+            shards = [spicy_bdd.Sharding(k, count, durations)
+                      for k in range(1, count + 1)]
+            picked = sum([[t.name for t in shard.select(map(Fake, names))]
+                          for shard in shards], [])
+            loads = shards[0].loads
+            return (sorted(picked), max(loads) / min(loads))
+        given(split=split)
+        when.split(4)
+        then.it[0].should.equal(sorted(names))
+        then.it[1].should.be.less_than(1.1)
+
+    def scenario_select_scenarios_affected_by_changes(self, given, when, then):
+        directory = self.temp_dir()
+        source = os.path.join(directory, "changed.py")
+        with open(source, "w") as f:
+            f.write("def double(x):\n    return x * 2\n")
+        def record_and_change(index):
+            index.record("changed", {os.path.relpath(source): ["double"]})
+            index.record("unchanged", {})
+            index.save()
+            with open(source, "a") as f:
+                f.write("# changed\n")
+            fresh = spicy_bdd.ImpactIndex(index.path)
+            return [x for x in ("changed", "unchanged", "new")
+                    if fresh.affected(x)]
+        given(record_and_change=record_and_change,
+              index=spicy_bdd.ImpactIndex(
+                  os.path.join(directory, "impact.json")))
+        when.record_and_change(given.index)
+        then.it.should.equal(["changed", "new"])
+
+    def scenario_watch_changed_sources(self, given, when, then):
+        directory = self.temp_dir()
+        source = os.path.join(directory, "watched.py")
+        with open(source, "w") as f:
+            f.write("")
+        def change(watcher):
+            os.utime(source, ns=(0, 0))
+            return watcher.changes(timeout=0)
+        given(change=change,
+              watcher=spicy_watch.PollingWatcher(directory))
+        when.change(given.watcher)
+        then.it.should.equal(set([source]))
+
+    def scenario_reload_modules_using_changed_ones(self, given, when, then):
+        changed = types.ModuleType("changed")
+        user = types.ModuleType("user")
+        user.helper = lambda: None
+        user.helper.__module__ = "changed"
+        indirect = types.ModuleType("indirect")
+        indirect.user = user
+        unrelated = types.ModuleType("unrelated")
+        given(dependents=spicy_watch.dependents,
+              modules=[changed, user, indirect, unrelated])
+        when.dependents(given.modules, [changed])
+        then.it.should.equal([changed, user, indirect])
+
+    def scenario_compare_benchmarks_with_baseline(self, given, when, then):
+        given(compare=spicy_bench.compare,
+              baseline={"given": {"ops_per_sec": 1000, "peak_bytes": 100}},
+              slower={"given": {"ops_per_sec": 800, "peak_bytes": 100}},
+              noisy={"given": {"ops_per_sec": 950, "peak_bytes": 105}})
+        when.compare(given.noisy, given.baseline, 0.1)
+        then.it.should.equal([])
+        when.compare(given.slower, given.baseline, 0.1)
+        then.it.should.equal([("given", "ops_per_sec", 1000, 800)])
+
+    def scenario_count_allocations_kept_by_a_call(self, given, when, then):
+        class Plain():
+            def __init__(self):
+                self.a = 1
+        class Slotted():
+            __slots__ = ("a",)
+            def __init__(self):
+                self.a = 1
+        def allocated(fn):
+            # a profiler of the suite would count its own allocations
+            if spicy_bdd.profiler is not None:
+                spicy_bdd.profiler.pause()
+            try:
+                (seconds, peak, allocations, size) = spicy_bench.measure(
+                    fn, min_time=0.001, repeat=1)
+            finally:
+                if spicy_bdd.profiler is not None:
+                    spicy_bdd.profiler.resume()
+            return (allocations, size)
+        given(allocated=allocated)
+        when.allocated(Slotted)
+        then.it[0].should.equal(1)
+        when.allocated(Plain)
+        then.it[1].should.be.greater_than(allocated(Slotted)[1])
+        # the It a then chain returns has slots, no __dict__ block
+        when.allocated(spicy_bench._then_chain(1))
+        then.it[0].should.be.less_than(2)
+        when.allocated(lambda: None)
+        then.it.should.equal((0, 0))
+
+    def scenario_fail_bench_slower_than_baseline(self, given, when, then):
+        directory = self.temp_dir()
+        delay = []
+        class Bench(InProcess, BddTest):
+            benchmark_baseline = os.path.join(directory, "baseline.json")
+            benchmark_threshold = 0.5
+            def bench_work(self, given, when, then):
+                given(work=lambda: delay and time.sleep(delay[0]))
+                when.work()
+        def run_twice(test):
+            # the first run stores the baseline, the slower second fails
+            outcomes = []
+            for i in range(2):
+                outcomes.append([str(e) for (x, e)
+                                 in _run_suite(test).failures])
+                delay.append(0.002)
+            return "%d then %d: %s" % (len(outcomes[0]), len(outcomes[1]),
+                                       "".join(outcomes[1]))
+        given(run_twice=run_twice, test=Bench(),
+              stored=lambda: sorted(json.load(open(
+                  Bench.benchmark_baseline))))
+        when.run_twice(given.test)
+        then.it.should.have.property("0 then 1: when work(): median ")
+        when.stored()
+        then.it.should.equal([Bench().id().rsplit(".", 1)[0]
+                              + ".bench_work"])
+
+    def scenario_measure_bench_without_recording_calls(self, given, when,
+                                                       then):
+        directory = self.temp_dir()
+        tracers = []
+        class Bench(InProcess, BddTest):
+            benchmark_baseline = os.path.join(directory, "baseline.json")
+            def bench_probe(self, given, when, then):
+                given(probe=lambda: tracers.append(sys.gettrace()))
+                when.probe()
+        def run(test):
+            saved = spicy_bdd.impact
+            spicy_bdd.impact = spicy_bdd.ImpactIndex(
+                os.path.join(directory, "impact.json"), load=False)
+            try:
+                _run_suite(test)
+            finally:
+                spicy_bdd.impact = saved
+            # recorded when the body ran, not while it was measured
+            return (tracers[0] is not None,
+                    set(tracers[2:]) == set([None]), sys.gettrace())
+        given(run=run, test=Bench())
+        when.run(given.test)
+        then.it.should.equal((not hasattr(sys, "monitoring"), True, None))
+
+    def scenario_measure_bench_without_profiling(self, given, when, then):
+        directory = self.temp_dir()
+        profilers = []
+        class Bench(InProcess, BddTest):
+            benchmark_baseline = os.path.join(directory, "baseline.json")
+            def bench_probe(self, given, when, then):
+                given(probe=lambda: profilers.append(sys.getprofile()))
+                when.probe()
+        def run(test):
+            saved = spicy_bdd.profiler
+            spicy_bdd.profiler = spicy_profile.SuiteProfile(
+                "cprofile", directory)
+            try:
+                _run_suite(test)
+            finally:
+                spicy_bdd.profiler = saved
+            return (profilers[0] is not None,
+                    set(profilers[2:]) == set([None]))
+        given(run=run, test=Bench())
+        when.run(given.test)
+        then.it.should.equal((not hasattr(sys, "monitoring"), True))
+
+    def scenario_merge_baselines_of_processes(self, given, when, then):
+        directory = self.temp_dir()
+        path = os.path.join(directory, "baseline.json")
+        def put_from_two_stores():
+            # both read the file before either writes it
+            (a, b) = (spicy_bench.BaselineStore(path),
+                      spicy_bench.BaselineStore(path))
+            a.get("a")
+            b.get("b")
+            a.put("a", {"median": 1})
+            b.put("b", {"median": 2})
+            return spicy_bench.BaselineStore(path).get("a")
+        given(put_from_two_stores=put_from_two_stores)
+        when.put_from_two_stores()
+        then.it.should.equal({"median": 1})
+
+    def scenario_reject_outlier_samples(self, given, when, then):
+        given(reject=spicy_bench.reject_outliers,
+              samples=[1.0, 1.1, 1.1, 1.2, 1.2, 1.3, 9.0])
+        when.reject(given.samples)
+        then.it.should.equal([1.0, 1.1, 1.1, 1.2, 1.2, 1.3])
+
+
+class ExamplesTest(BddTest):
+    @examples(lambda: ({"a": i, "b": i * 2} for i in range(5)), batch=2)
+    def scenario_double_a_number(self, given, when, then):
+        given(double=lambda x: x * 2)
+        when.double(given.a)
+        then.it.should.equal(given.b)
+
+
+class FactoryTest(BddTest):
+    # class scoped givens are shared between scenarios, so keep them in
+    # one process
+    workers = 1
+    isolation = False
+    shard_together = True
+    built = []
+
+    def define_numbers(self):
+        FactoryTest.built.append("numbers")
+        yield [1, 2, 3]
+        FactoryTest.built.append("numbers closed")
+
+    def scenario_a_build_class_scoped_given_once(self, given, when, then):
+        given(count=FactoryTest.built.count)
+        when.numbers.append(4)
+        then.count("numbers").should.equal(1)
+
+    def scenario_b_share_class_scoped_given(self, given, when, then):
+        given(count=FactoryTest.built.count)
+        when.numbers.copy()
+        then.it.should.equal([1, 2, 3, 4])
+        then.count("numbers").should.equal(1)
+
+    def scenario_c_build_only_used_givens(self, given, when, then):
+        given(unused=factory(lambda: 1 / 0),
+              answer=factory(lambda: 42))
+        when.answer.bit_length()
+        then.it.should.equal(6)
+
+
+class ForkIsolationTest(BddTest):
+    isolation = "fork"
+
+    def define_shared(self):
+        return [os.getpid()]
+
+    def scenario_a_mutate_shared_given(self, given, when, then):
+        given(parent_pid=os.getppid())
+        when.shared.append(1)
+        then.shared.length.should.equal(2)
+        then.shared[0].should.equal(given.parent_pid)
+
+    def scenario_b_see_shared_given_unchanged(self, given, when, then):
+        when.shared.copy()
+        then.it.length.should.equal(1)
+
+
+class PropertyTest(BddTest):
+    property_examples = 50
+
+    def scenario_add_in_any_order(self, given, when, then):
+        given(a=integers(), b=integers(),
+              add=lambda x, y: x + y)
+        when.add(given.a, given.b)
+        then.it.should.equal(given.b.value + given.a.value)
+
+    def scenario_join_and_split_text(self, given, when, then):
+        given(words=lists(text(alphabet="ab", min_size=1), min_size=1),
+              split=lambda words: " ".join(words).split(" "))
+        when.split(given.words)
+        then.it.should.equal(given.words)
+
+    def scenario_shrink_to_minimal_example(self, given, when, then):
+        class Failing(InProcess, BddTest):
+            def scenario_small(self, given, when, then):
+                given(n=integers(0, 10 ** 6),
+                      pair=builds(tuple, lists(integers(), max_size=2)))
+                then.n.should.be.less_than(1000)
+        given(message=lambda test: str(_run_suite(test).failures[0][1]))
+        when.message(Failing())
+        then.it.should.have.property("falsifying example: n=1000, pair=()")
+
+
+class PropertyWorkersTest(BddTest):
+    # examples run in pool workers, each between setUp and tearDown
+    property_examples = 20
+    property_workers = 2
+
+    def setUp(self):
+        self.base = 10
+
+    def tearDown(self):
+        del self.base
+
+    def scenario_use_state_of_set_up(self, given, when, then):
+        given(n=integers(), add=lambda x: x + self.base)
+        when.add(given.n)
+        then.it.should.equal(given.n.value + 10)
+
+
+class _Connection():
+    async def read(self):
+        await asyncio.sleep(0)
+        return "data"
+
+async def _connect():
+    await asyncio.sleep(0)
+    return _Connection()
+
+async def _fail():
+    raise ValueError("refused")
+
+
+class AsyncTest(BddTest):
+    workers = 1
+    isolation = False
+    async_concurrency = 4
+    shard_together = True
+    running = [0, 0]
+
+    async def scenario_a_await_when_chain(self, given, when, then):
+        given(connect=_connect)
+        await when.connect().read()
+        then.it.should.equal("data")
+
+    async def scenario_b_await_then_value(self, given, when, then):
+        given(fail=_fail)
+        (await then.fail()).should._raise(ValueError)
+
+    async def _run_with_other(self, given, then):
+        given(running=self.running)
+        self.running[0] += 1
+        self.running[1] = max(self.running)
+        await asyncio.sleep(0.01)
+        self.running[0] -= 1
+        then.running[1].should.equal(2)
+
+    async def scenario_c_run_concurrently(self, given, when, then):
+        await self._run_with_other(given, then)
+
+    async def scenario_d_run_concurrently_too(self, given, when, then):
+        await self._run_with_other(given, then)
+
+    def scenario_e_run_sync_scenario_too(self, given, when, then):
+        given(add=lambda x, y: x + y)
+        when.add(1, 2)
+        then.it.should.equal(3)
+
+
+class ParallelBddTestTest(BddTestTest):
+    workers = 2
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,334 @@
+import os
+import sys
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import argparse
+import importlib
+import unittest
+import multiprocessing
+
+import spicy_bdd
+
+# reruns the scenarios affected by every change of the source tree.
+#
+#   python spicy_watch.py spicy_test          watch the current directory
+#   python spicy_watch.py --poll spicy_test   without inotify
+#
+# the test modules stay imported in a worker process. on a change it
+# reloads the changed modules and the ones which use them, and runs the
+# scenarios whose recorded calls (see spicy_bdd.ImpactIndex) went into
+# the changed files, the new ones, and the ones which failed last time.
+
+SKIPPED_DIRS = set([".git", ".spicy", "__pycache__", ".tox", ".venv"])
+
+
+def _is_source(name):
+    return name.endswith(".py") and not name.startswith(".")
+
+
+class PollingWatcher():
+    # compares the mtimes of the .py files under root every interval
+    def __init__(self, root, interval=0.2):
+        self.root = root
+        self.interval = interval
+        self._mtimes = self._scan()
+
+    def _scan(self):
+        mtimes = {}
+        for (directory, dirs, files) in os.walk(self.root):
+            dirs[:] = [x for x in dirs if x not in SKIPPED_DIRS]
+            for name in files:
+                if _is_source(name):
+                    path = os.path.join(directory, name)
+                    try:
+                        mtimes[path] = os.stat(path).st_mtime_ns
+                    except OSError:
+                        pass
+        return mtimes
+
+    def changes(self, timeout=None):
+        # returns the set of changed paths, waiting up to timeout seconds
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            mtimes = self._scan()
+            changed = set([path for (path, mtime) in mtimes.items()
+                           if self._mtimes.get(path) != mtime])
+            changed.update([x for x in self._mtimes if x not in mtimes])
+            self._mtimes = mtimes
+            if changed:
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return changed
+            time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher():
+    # linux inotify through ctypes, one watch per directory
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_ISDIR = 0x40000000
+    MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+            | IN_DELETE | IN_MODIFY)
+    _event = struct.Struct("iIII")
+
+    def __init__(self, root, settle=0.05):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._libc = libc
+        self._fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        # editors write a file in several steps; wait for them to settle
+        self.settle = settle
+        self._dirs = {}
+        for (directory, dirs, files) in os.walk(root):
+            dirs[:] = [x for x in dirs if x not in SKIPPED_DIRS]
+            self._watch(directory)
+
+    def _watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory),
+                                          self.MASK)
+        if wd >= 0:
+            self._dirs[wd] = directory
+
+    def _read(self, timeout):
+        changed = set()
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return changed
+        data = os.read(self._fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            directory = self._dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) \
+                   and name not in SKIPPED_DIRS:
+                    self._watch(path)
+            elif _is_source(name):
+                changed.add(path)
+        return changed
+
+    def changes(self, timeout=None):
+        changed = self._read(timeout)
+        while changed:
+            more = self._read(self.settle)
+            if not more:
+                break
+            changed.update(more)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+def make_watcher(root, poll=False, interval=0.2):
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError, TypeError):
+            pass
+    return PollingWatcher(root, interval)
+
+
+def dependents(modules, changed):
+    # the modules which use one of the changed modules, directly or
+    # through another one, by the objects found in their namespaces
+    names = set([x.__name__ for x in changed])
+    affected = list(changed)
+    grew = True
+    while grew:
+        grew = False
+        for module in modules:
+            if module.__name__ in names:
+                continue
+            for value in list(vars(module).values()):
+                owner = getattr(value, "__name__", None) \
+                    if isinstance(value, type(sys)) \
+                    else getattr(value, "__module__", None)
+                if owner in names:
+                    names.add(module.__name__)
+                    affected.append(module)
+                    grew = True
+                    break
+    return affected
+
+
+class Worker():
+    # the test modules, imported once and reloaded as they change
+    def __init__(self, names, root, index_path):
+        self.names = names
+        self.root = os.path.abspath(root)
+        self.index = spicy_bdd.ImpactIndex(index_path, load=False)
+        spicy_bdd.impact = self.index
+        self.modules = [importlib.import_module(x) for x in names]
+
+    def _project_modules(self):
+        # in import order, which puts a module after the ones it imports
+        modules = []
+        for module in list(sys.modules.values()):
+            path = getattr(module, "__file__", None)
+            if not path or os.path.basename(path) in spicy_bdd.FRAMEWORK:
+                continue
+            path = os.path.abspath(path)
+            if path.startswith(self.root + os.sep):
+                modules.append(module)
+        return modules
+
+    def reload(self, paths):
+        paths = set([os.path.abspath(x) for x in paths])
+        modules = self._project_modules()
+        changed = [x for x in modules
+                   if os.path.abspath(x.__file__) in paths]
+        for module in dependents(modules, changed):
+            importlib.reload(module)
+        self.modules = [sys.modules[x] for x in self.names]
+
+    def run(self, stream=None):
+        self.index.refresh()
+        suite = unittest.TestSuite()
+        for module in self.modules:
+            suite.addTests(unittest.defaultTestLoader.loadTestsFromModule(
+                module))
+        runner = unittest.TextTestRunner(stream=stream or sys.stderr)
+        started = time.perf_counter()
+        result = runner.run(suite)
+        return {"run": result.testsRun,
+                "failures": len(result.failures),
+                "errors": len(result.errors),
+                "seconds": time.perf_counter() - started}
+
+
+def _serve(conn, names, root, index_path):
+    # the worker process: runs everything once, then what each change
+    # sent by the parent affects
+    worker = Worker(names, root, index_path)
+    try:
+        conn.send(worker.run())
+        while True:
+            paths = conn.recv()
+            if paths is None:
+                break
+            try:
+                worker.reload(paths)
+            except Exception as e:
+                # a syntax error, say; the next change will fix it
+                print("reload failed: %s" % e, file=sys.stderr)
+                conn.send(None)
+                continue
+            conn.send(worker.run())
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        worker.index.save()
+
+
+class WorkerProcess():
+    def __init__(self, names, root, index_path):
+        self._args = (names, root, index_path)
+        self._start()
+
+    def _start(self):
+        method = "fork" if hasattr(os, "fork") else "spawn"
+        context = multiprocessing.get_context(method)
+        (self._conn, child) = context.Pipe()
+        self._process = context.Process(target=_serve,
+                                        args=(child,) + self._args,
+                                        daemon=True)
+        self._process.start()
+        child.close()
+
+    def result(self):
+        try:
+            return self._conn.recv()
+        except EOFError:
+            return None
+
+    def rerun(self, paths):
+        try:
+            self._conn.send(sorted(paths))
+        except OSError:
+            # the worker died; a fresh one runs everything
+            self._start()
+        return self.result()
+
+    def restart(self):
+        self.stop()
+        self._start()
+
+    def stop(self):
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+        self._process.join(5)
+        if self._process.is_alive():
+            self._process.kill()
+
+
+def _summary(summary):
+    if summary is None:
+        return "worker failed, waiting for the next change"
+    return ("%(run)d run, %(failures)d failures, %(errors)d errors "
+            "in %(seconds).3fs" % summary)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="rerun spicy_bdd scenarios on every change")
+    parser.add_argument("modules", nargs="+",
+                        help="test modules to import and run")
+    parser.add_argument("--root", default=".",
+                        help="directory to watch")
+    parser.add_argument("--poll", action="store_true",
+                        help="poll mtimes instead of using inotify")
+    parser.add_argument("--interval", type=float, default=0.2,
+                        help="seconds between polls")
+    parser.add_argument("--impact-index", metavar="FILE",
+                        default=".spicy/impact.json",
+                        help="where the worker saves its impact index")
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.path.abspath(args.root))
+    watcher = make_watcher(args.root, args.poll, args.interval)
+    worker = WorkerProcess(args.modules, args.root, args.impact_index)
+    print(_summary(worker.result()), file=sys.stderr)
+    try:
+        while True:
+            changed = watcher.changes()
+            if not changed:
+                continue
+            names = set([os.path.basename(x) for x in changed])
+            # a change of spicy itself restarts the worker rather than
+            # being reloaded
+            if names & set(spicy_bdd.FRAMEWORK):
+                print("framework changed, restarting", file=sys.stderr)
+                worker.restart()
+                summary = worker.result()
+            else:
+                summary = worker.rerun(changed)
+            print(_summary(summary), file=sys.stderr)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        worker.stop()
+        watcher.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())